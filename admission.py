@@ -0,0 +1,126 @@
+import logging
+import threading
+import time
+from collections import deque
+from typing import Dict, Sequence, Deque
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Modes:
+    FULL = 0  # normal captcha
+    REDUCED = 1  # smaller image
+    MINIMAL = 2  # smaller image and fewer emojis
+    POOLED = 3  # reuse a recently rendered image
+    DEFERRED = 4  # restrict the user now, send the captcha later
+
+    NAMES = ("full", "reduced", "minimal", "pooled", "deferred")
+
+
+def level_for(value: float, thresholds: Sequence[int]) -> int:
+    # thresholds[i] is the value needed to step down to mode i + 1
+    level = Modes.FULL
+    for i, threshold in enumerate(thresholds):
+        if threshold and value >= threshold:
+            level = i + 1
+
+    return min(level, Modes.DEFERRED)
+
+
+class AdmissionController:
+    def __init__(
+            self,
+            window: int = 60,  # seconds
+            chat_thresholds: Sequence[int] = (10, 30, 60, 120),  # joins per window in a chat
+            global_thresholds: Sequence[int] = (30, 90, 180, 360),  # joins per window in all the chats
+            queue_thresholds: Sequence[int] = (5, 15, 30, 60),  # pending updates
+            enabled: bool = True
+    ):
+        self.window = window
+        self.chat_thresholds = tuple(chat_thresholds)
+        self.global_thresholds = tuple(global_thresholds)
+        self.queue_thresholds = tuple(queue_thresholds)
+        self.enabled = enabled
+
+        self._lock = threading.Lock()
+        self._global_joins: Deque[float] = deque()
+        self._chat_joins: Dict[int, Deque[float]] = {}
+        self._chat_in_flight: Dict[int, int] = {}
+
+    @classmethod
+    def from_config(cls, load_shedding_config):
+        if not load_shedding_config:
+            return cls(enabled=False)
+
+        return cls(
+            window=load_shedding_config.get("window", 60),
+            chat_thresholds=load_shedding_config.get("chat_thresholds", (10, 30, 60, 120)),
+            global_thresholds=load_shedding_config.get("global_thresholds", (30, 90, 180, 360)),
+            queue_thresholds=load_shedding_config.get("queue_thresholds", (5, 15, 30, 60)),
+            enabled=load_shedding_config.get("enabled", True)
+        )
+
+    def _trim(self, joins: Deque[float], now: float):
+        while joins and now - joins[0] > self.window:
+            joins.popleft()
+
+    def join(self, chat_id: int, queue_depth: int = 0) -> int:
+        """Record a join in the chat and return the mode its captcha should use"""
+        now = time.monotonic()
+
+        with self._lock:
+            chat_joins = self._chat_joins.setdefault(chat_id, deque())
+            chat_joins.append(now)
+            self._global_joins.append(now)
+            self._trim(chat_joins, now)
+            self._trim(self._global_joins, now)
+
+            chat_rate = len(chat_joins)
+            global_rate = len(self._global_joins)
+            in_flight = self._chat_in_flight.get(chat_id, 0)
+
+            # forget quiet chats
+            for other_chat_id in [c for c, j in self._chat_joins.items() if not j or now - j[-1] > self.window]:
+                self._chat_joins.pop(other_chat_id, None)
+
+        mode = Modes.FULL
+        if self.enabled:
+            mode = max(
+                level_for(chat_rate, self.chat_thresholds),
+                level_for(global_rate, self.global_thresholds),
+                level_for(queue_depth + in_flight, self.queue_thresholds)
+            )
+
+        metrics.set_gauge("admission.global_joins", global_rate)
+        metrics.set_gauge("admission.queue_depth", queue_depth)
+        metrics.set_gauge("admission.last_mode", mode)
+        metrics.incr(f"admission.mode.{Modes.NAMES[mode]}")
+
+        if mode != Modes.FULL:
+            logger.debug("chat %d: %d joins in the last %ds (%d globally, queue: %d): mode %s",
+                         chat_id, chat_rate, self.window, global_rate, queue_depth, Modes.NAMES[mode])
+
+        return mode
+
+    def begin(self, chat_id: int):
+        with self._lock:
+            self._chat_in_flight[chat_id] = self._chat_in_flight.get(chat_id, 0) + 1
+
+    def end(self, chat_id: int):
+        with self._lock:
+            in_flight = self._chat_in_flight.get(chat_id, 0) - 1
+            if in_flight > 0:
+                self._chat_in_flight[chat_id] = in_flight
+            else:
+                self._chat_in_flight.pop(chat_id, None)
+
+    def describe(self):
+        return (
+            f"load shedding: {'enabled' if self.enabled else 'disabled'}, window: {self.window}s\n"
+            f"modes: {', '.join(Modes.NAMES)}\n"
+            f"chat thresholds: {self.chat_thresholds}\n"
+            f"global thresholds: {self.global_thresholds}\n"
+            f"queue thresholds: {self.queue_thresholds}"
+        )
@@ -0,0 +1,99 @@
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from telegram.error import RetryAfter, NetworkError, TelegramError, BadRequest
+from telegram.utils.request import Request
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# methods that can be sent again after a timeout without side effects (the request might have reached Telegram)
+IDEMPOTENT_METHODS = (
+    "getMe",
+    "getChatAdministrators",
+    "getChatMember",
+    "restrictChatMember",
+    "banChatMember",
+    "deleteMessage",
+    "setMyCommands",
+    "editMessageReplyMarkup",
+)
+
+_local = threading.local()
+
+
+def current_retry_deadline() -> Optional[float]:
+    return getattr(_local, "deadline", None)
+
+
+@contextmanager
+def retry_deadline(deadline: Optional[float]):
+    # don't wait for retries past the deadline (a time.monotonic() value) for the calls made in this block
+    previous = getattr(_local, "deadline", None)
+    _local.deadline = deadline
+    try:
+        yield
+    finally:
+        _local.deadline = previous
+
+
+class InstrumentedRequest(Request):
+    """Request that records per-method latency and errors, and retries flood-limited and timed out calls"""
+
+    __slots__ = ("max_retries", "max_retry_after")  # Request warns about attributes that are not declared
+
+    def __init__(self, *args, max_retries: int = 3, max_retry_after: int = 30, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.max_retries = max_retries
+        self.max_retry_after = max_retry_after  # don't wait for longer flood limits: raise the error instead
+
+    def _retry_delay(self, method: str, attempt: int, error: TelegramError) -> Optional[float]:
+        # seconds to wait before the next attempt, None to give up
+        if attempt > self.max_retries:
+            return None
+
+        if isinstance(error, RetryAfter):
+            if error.retry_after > self.max_retry_after:
+                return None
+            delay = error.retry_after + random.uniform(0, 1)
+        elif method in IDEMPOTENT_METHODS:
+            delay = min(2 ** attempt, 10) * random.uniform(0.5, 1.5)
+        else:
+            return None
+
+        deadline = getattr(_local, "deadline", None)
+        if deadline and time.monotonic() + delay > deadline:
+            return None
+
+        return delay
+
+    def post(self, url, data, timeout=None):
+        method = url.rsplit("/", 1)[-1]
+
+        attempt = 0
+        while True:
+            attempt += 1
+            start = time.perf_counter()
+            try:
+                result = super().post(url, data, timeout=timeout)
+                metrics.observe(f"api.{method}", time.perf_counter() - start)
+                return result
+            except TelegramError as e:
+                metrics.observe(f"api.{method}", time.perf_counter() - start)
+
+                # BadRequest is a NetworkError too, but sending the same request again won't help
+                retryable = isinstance(e, RetryAfter) or (isinstance(e, NetworkError) and not isinstance(e, BadRequest))
+                delay = self._retry_delay(method, attempt, e) if retryable else None
+                if delay is None:
+                    metrics.incr(f"api.{method}.errors")
+                    raise
+
+                metrics.incr(f"api.{method}.retries")
+                logger.warning("%s failed (%s), attempt %d: retrying in %.1f seconds", method, str(e), attempt, delay)
+                time.sleep(delay)
@@ -0,0 +1,204 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+LEGACY_FILE_NAME = re.compile(r"^background_(\d+)\.jpg$")  # one file per chat, before the store
+
+
+class BackgroundStore:
+    """Chat backgrounds stored once per content (sha256), with chat -> hash references"""
+
+    def __init__(self, dir_path="backgrounds", max_bytes=500 * 1024 * 1024, max_idle_days=180):
+        self.dir_path = Path(dir_path)
+        self.index_file = self.dir_path / "index.json"
+        self.max_bytes = max_bytes  # disk budget: unreferenced images are deleted when it's exceeded
+        self.max_idle_days = max_idle_days  # chats whose background wasn't used for this long go back to the default (0: never)
+
+        self._lock = threading.Lock()
+        self.chats: Dict[int, str] = {}  # chat_id -> hash
+        self.objects: Dict[str, dict] = {}  # hash -> {"size", "last_used", "file_unique_id"}
+        self.file_unique_ids: Dict[str, str] = {}  # Telegram's file_unique_id -> hash, to skip the download
+        self.forgotten_chats: Set[int] = set()  # idle chats to remove from the saved index too
+        self._changed = False
+
+        self.dir_path.mkdir(exist_ok=True)
+        self.load()
+        self.import_legacy_files()
+
+    def object_path(self, digest: str) -> Path:
+        return self.dir_path / f"{digest}.jpg"
+
+    def read_index(self) -> dict:
+        try:
+            with open(self.index_file, "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {"chats": {}, "objects": {}}
+
+    def load(self):
+        saved = self.read_index()
+        self.chats = {int(chat_id): digest for chat_id, digest in saved["chats"].items()}
+        self.objects = {digest: entry for digest, entry in saved["objects"].items() if self.object_path(digest).exists()}
+        self.file_unique_ids = {entry["file_unique_id"]: digest for digest, entry in self.objects.items() if entry.get("file_unique_id")}
+
+        # references to missing files
+        self.chats = {chat_id: digest for chat_id, digest in self.chats.items() if digest in self.objects}
+
+    def save(self):
+        with self._lock:
+            if not self._changed:
+                return
+            self._changed = False
+            chats = {str(chat_id): digest for chat_id, digest in self.chats.items()}
+            objects = dict(self.objects)
+            forgotten_chats, self.forgotten_chats = self.forgotten_chats, set()
+
+        # with shards, every worker process saves its own chats in the same index
+        saved = self.read_index()
+        saved["chats"].update(chats)
+        for chat_id in forgotten_chats:
+            saved["chats"].pop(str(chat_id), None)
+        saved["objects"].update(objects)
+        saved["objects"] = {digest: entry for digest, entry in saved["objects"].items() if self.object_path(digest).exists()}
+        saved["chats"] = {chat_id: digest for chat_id, digest in saved["chats"].items() if digest in saved["objects"]}
+
+        tmp_file = self.index_file.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(saved, f)
+        os.replace(tmp_file, self.index_file)
+
+        logger.debug("saved the backgrounds index: %d chats, %d images", len(saved["chats"]), len(saved["objects"]))
+
+    def import_legacy_files(self):
+        imported = 0
+        for file_path in self.dir_path.iterdir():
+            match = LEGACY_FILE_NAME.match(file_path.name)
+            if not match:
+                continue
+
+            chat_id = int(f"-100{match.group(1)}")  # legacy file names don't have the supergroups' -100 prefix
+            digest = self.add(file_path.read_bytes())
+            self.assign(chat_id, digest)
+            file_path.unlink()
+            imported += 1
+
+        if imported:
+            logger.info("imported %d backgrounds into the store", imported)
+            self.save()
+
+    def forget_missing(self, digest: str) -> bool:
+        # drop an object whose file is gone (evicted by another worker process, or deleted by hand), with the
+        # chats using it. True if it was missing
+        if self.object_path(digest).exists():
+            return False
+
+        with self._lock:
+            entry = self.objects.pop(digest, None)
+            if entry:
+                self.file_unique_ids.pop(entry.get("file_unique_id"), None)
+            for chat_id in [chat_id for chat_id, chat_digest in self.chats.items() if chat_digest == digest]:
+                del self.chats[chat_id]
+                self.forgotten_chats.add(chat_id)
+            self._changed = True
+
+        logger.warning("background %s is missing, using the default one", digest)
+        return True
+
+    def find(self, file_unique_id: str) -> Optional[str]:
+        # hash of an image already in the store
+        digest = self.file_unique_ids.get(file_unique_id)
+        if not digest or self.forget_missing(digest):
+            return None
+
+        return digest
+
+    def add(self, data: bytes, file_unique_id: Optional[str] = None) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            if digest not in self.objects:
+                # identical images uploaded by different chats are stored once
+                tmp_path = self.object_path(digest).with_suffix(".tmp")
+                tmp_path.write_bytes(data)
+                os.replace(tmp_path, self.object_path(digest))
+                self.objects[digest] = {"size": len(data), "last_used": time.time(), "file_unique_id": file_unique_id}
+            elif file_unique_id and not self.objects[digest].get("file_unique_id"):
+                self.objects[digest]["file_unique_id"] = file_unique_id
+
+            if file_unique_id:
+                self.file_unique_ids[file_unique_id] = digest
+            self._changed = True
+
+        return digest
+
+    def assign(self, chat_id: int, digest: str):
+        with self._lock:
+            self.chats[chat_id] = digest
+            self.objects[digest]["last_used"] = time.time()
+            self._changed = True
+
+        self.evict()
+
+    def path_for(self, chat_id: int) -> Optional[Path]:
+        digest = self.chats.get(chat_id)
+        if not digest or self.forget_missing(digest):
+            return None
+
+        entry = self.objects.get(digest)
+        if entry:
+            entry["last_used"] = time.time()  # persisted by the next save()
+            self._changed = True
+
+        return self.object_path(digest)
+
+    def disk_usage(self) -> int:
+        return sum(entry["size"] for entry in self.objects.values())
+
+    def evict(self) -> int:
+        # forget the backgrounds of idle chats, then delete the least recently used unreferenced images
+        # while the store is over its budget
+        now = time.time()
+        removed = []
+        # chats of the other worker processes, if any
+        saved_references = {digest for chat_id, digest in self.read_index()["chats"].items() if int(chat_id) not in self.chats}
+        with self._lock:
+            if self.max_idle_days:
+                idle_since = now - self.max_idle_days * 24 * 60 * 60
+                for chat_id, digest in list(self.chats.items()):
+                    if self.objects[digest]["last_used"] < idle_since:
+                        del self.chats[chat_id]
+                        self.forgotten_chats.add(chat_id)
+                        self._changed = True
+
+            referenced = set(self.chats.values()) | saved_references
+            total = self.disk_usage()
+            unreferenced = sorted((entry["last_used"], digest) for digest, entry in self.objects.items() if digest not in referenced)
+            for _, digest in unreferenced:
+                if total <= self.max_bytes:
+                    break
+
+                entry = self.objects.pop(digest)
+                self.file_unique_ids.pop(entry.get("file_unique_id"), None)
+                total -= entry["size"]
+                removed.append(digest)
+
+            if removed:
+                self._changed = True
+
+        for digest in removed:
+            try:
+                self.object_path(digest).unlink()
+            except FileNotFoundError:
+                pass
+
+        if removed:
+            logger.info("evicted %d backgrounds, %d bytes used", len(removed), total)
+
+        return len(removed)
@@ -0,0 +1,336 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import queue
+import random
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+GOLDEN_FILE = "assets/golden.json"
+GOLDEN_TOLERANCE = 4.0  # max mean absolute difference of the thumbnails when the pixels hash doesn't match
+GOLDEN_BACKGROUND = "assets/bg.default.png"
+GOLDEN_EMOJIS = ("1f004", "1f0cf", "1f18e", "1f191", "1f192", "1f193")
+MICRO_SIZES = (10, 100, 1000, 10000, 100000)  # pending captchas in the synthetic chat_data
+MICRO_USERS_PER_CHAT = 100
+
+FORMAT = "[%(asctime)s][%(name)s][%(module)s:%(funcName)s:%(lineno)d][%(levelname)s] >>> %(message)s"
+
+
+def timed(func, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        func(i)
+
+    return (time.perf_counter() - start) / iterations
+
+
+def bench_logging(args, iterations=10000):
+    # same handlers as logging.json: a rotating file and the console (redirected to /dev/null)
+    with tempfile.TemporaryDirectory() as tmp_dir, open(os.devnull, "w") as devnull:
+        formatter = logging.Formatter(FORMAT)
+        file_handler = RotatingFileHandler(os.path.join(tmp_dir, "bench.log"), maxBytes=1048576, backupCount=5, encoding="utf8")
+        console_handler = logging.StreamHandler(devnull)
+        for handler in (file_handler, console_handler):
+            handler.setFormatter(formatter)
+
+        bench_logger = logging.getLogger("benchmarks.logging")
+        bench_logger.propagate = False
+        bench_logger.setLevel(logging.DEBUG)
+
+        results = {}
+
+        bench_logger.handlers = [file_handler, console_handler]
+        results["sync"] = timed(lambda i: bench_logger.debug("user selected emoji: %s (correct: %s)", i, True), iterations)
+
+        log_queue = queue.SimpleQueue()
+        listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+        listener.start()
+        bench_logger.handlers = [QueueHandler(log_queue)]
+        results["queue"] = timed(lambda i: bench_logger.debug("user selected emoji: %s (correct: %s)", i, True), iterations)
+        listener.stop()
+
+        # disabled level: eager f-string vs lazy formatting
+        bench_logger.setLevel(logging.INFO)
+        results["disabled_eager"] = timed(lambda i: bench_logger.debug(f"cell {i}x{i}: {i:3}, {i:3}"), iterations)
+        results["disabled_lazy"] = timed(lambda i: bench_logger.debug("cell %dx%d: %3d, %3d", i, i, i, i), iterations)
+
+        bench_logger.handlers = []
+        file_handler.close()
+
+    print(f"logging ({iterations} calls)")
+    for name, seconds in results.items():
+        print(f"  {name:<16} {seconds * 1000000:8.2f} us/call")
+    print(f"  handler latency removed by the queue: {(results['sync'] - results['queue']) * 1000000:.2f} us/call")
+
+    return results
+
+
+def golden_specs():
+    from images import CaptchaSpec, RenderProfile
+    from layout import Layouts
+
+    specs = {}
+    for layout in Layouts.ALL:
+        for emojis_number in (1, 3, 6):
+            name = f"{layout}-{emojis_number}"
+            profile = RenderProfile(max_side=512, layout=layout)
+            specs[name] = CaptchaSpec(1000 + emojis_number, GOLDEN_EMOJIS[:emojis_number], GOLDEN_BACKGROUND, profile)
+
+        # the 'reduced' load shedding mode: small emojis, shrunk the most
+        profile = RenderProfile(max_side=320, layout=layout)
+        specs[f"{layout}-6-320"] = CaptchaSpec(1006, GOLDEN_EMOJIS, GOLDEN_BACKGROUND, profile)
+
+    return specs
+
+
+def thumbnail(img):
+    return list(img.convert("L").resize((16, 16)).getdata())
+
+
+def bench_golden(args):
+    # render fixed specs like send_captcha() does (catalog bounding boxes, cached backgrounds): the images must match
+    # the golden ones (same pixels, or within the tolerance)
+    from images import CaptchaImage
+    from main import get_emojis, background_cache
+
+    try:
+        with open(GOLDEN_FILE, "r") as f:
+            goldens = json.load(f)
+    except FileNotFoundError:
+        goldens = {}
+
+    print("golden images")
+    results = {}
+    failed = []
+    for name, spec in golden_specs().items():
+        start = time.perf_counter()
+        captcha_image = CaptchaImage.from_spec(spec, catalog=get_emojis(), backgrounds=background_cache)
+        captcha_image.generate_capctha_image(tempfile.SpooledTemporaryFile(), image_format=spec.profile.image_format)
+        seconds = time.perf_counter() - start
+
+        pixels_hash = hashlib.sha256(captcha_image.bg_img.tobytes()).hexdigest()
+        result = {"hash": pixels_hash, "thumbnail": thumbnail(captcha_image.bg_img)}
+        results[name] = result
+
+        status = "new"
+        golden = goldens.get(name)
+        if golden and golden["hash"] == pixels_hash:
+            status = "ok"
+        elif golden:
+            difference = sum(abs(a - b) for a, b in zip(golden["thumbnail"], result["thumbnail"])) / len(result["thumbnail"])
+            status = f"ok (difference: {difference:.2f})" if difference <= GOLDEN_TOLERANCE else f"FAILED (difference: {difference:.2f})"
+            if difference > GOLDEN_TOLERANCE:
+                failed.append(name)
+
+        print(f"  {name:<14} {seconds * 1000:8.2f} ms  {status}")
+
+    if args.update_golden:
+        with open(GOLDEN_FILE, "w") as f:
+            json.dump(results, f)
+        print(f"golden images saved to {GOLDEN_FILE}")
+    elif failed:
+        raise SystemExit(f"golden images mismatch: {', '.join(failed)}")
+
+    return results
+
+
+def bench_sprite(args, iterations=500):
+    # per-sprite cost of rotate + resize (two resampling passes) vs one affine transform.
+    # Pillow allocates the pixels outside of the python heap: count the bytes of every image created instead
+    from PIL import Image
+    from images import transform_sprite
+
+    sprite = Image.open(os.path.join("emojis", f"{GOLDEN_EMOJIS[0]}.png")).convert("RGBA")
+    size = 64
+
+    def rotate_resize(i):
+        rotated = sprite.rotate(20 + i % 70, expand=True)
+        scale = size / max(rotated.size)
+        resized = rotated.resize((max(1, round(rotated.width * scale)), max(1, round(rotated.height * scale))), Image.ANTIALIAS)
+        return resized
+
+    def affine(i):
+        return transform_sprite(sprite, 20 + i % 70, size)
+
+    def allocated_bytes(func):
+        created = []
+        original_new = Image.Image._new
+
+        def tracking_new(self, im):
+            image = original_new(self, im)
+            created.append(len(image.mode) * image.width * image.height)
+            return image
+
+        Image.Image._new = tracking_new
+        try:
+            func(0)
+        finally:
+            Image.Image._new = original_new
+
+        return sum(created)
+
+    print(f"sprite ({iterations} sprites, {sprite.width}x{sprite.height} -> {size}x{size})")
+    results = {}
+    for name, func in (("rotate_resize", rotate_resize), ("affine", affine)):
+        allocated = allocated_bytes(func)
+        seconds = timed(func, iterations)
+        results[name] = {"seconds": seconds, "allocated": allocated}
+        print(f"  {name:<16} {seconds * 1000000:8.2f} us/sprite  {allocated / 1024:8.1f} KB of images allocated")
+
+    return results
+
+
+def allocations(func, iterations=100):
+    # blocks and bytes still allocated after each call (the results are kept alive), and the peak bytes of one call
+    results = []
+    tracemalloc.start()
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    before = tracemalloc.take_snapshot().filter_traces(ignore)
+    for i in range(iterations):
+        results.append(func(i))
+    after = tracemalloc.take_snapshot().filter_traces(ignore)
+
+    tracemalloc.reset_peak()
+    baseline, _ = tracemalloc.get_traced_memory()
+    func(iterations)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    stats = after.compare_to(before, "filename")
+    return {
+        "blocks": sum(stat.count_diff for stat in stats) / iterations,
+        "bytes": sum(stat.size_diff for stat in stats) / iterations,
+        "peak_bytes": peak - baseline,
+    }
+
+
+def measure(func, iterations):
+    result = {"seconds": timed(func, iterations)}
+    result.update(allocations(func, min(iterations, 100)))
+    return result
+
+
+class OfflineBot:
+    # answers the api calls made by the micro benchmarks
+    def __init__(self, admin_ids):
+        from types import SimpleNamespace
+
+        self.admins = [SimpleNamespace(user=SimpleNamespace(id=admin_id)) for admin_id in admin_ids]
+
+    def get_chat_administrators(self, chat_id):
+        return self.admins
+
+
+def synthetic_chat_data(size: int, captcha_factory):
+    # 'size' pending captchas, MICRO_USERS_PER_CHAT per chat
+    chat_data = defaultdict(dict)
+    for user_id in range(size):
+        chat_id = -1001000000000 - user_id // MICRO_USERS_PER_CHAT
+        chat_data[chat_id][user_id] = {"captcha": captcha_factory(user_id)}
+
+    return chat_data
+
+
+def bench_micro(args, iterations=2000):
+    # the hot paths that don't touch the image: per join, per click and per expiry sweep. Runs offline: no api call
+    from types import SimpleNamespace
+
+    from capacity import FAKE_CHAT, fake_user
+    from config import config
+    import main
+
+    emojis = main.get_emojis()
+    buttons = config.captcha.image_buttons
+    emojis_number = config.captcha.image_emojis
+
+    def new_captcha(i):
+        return main.EmojiCaptcha(
+            fake_user(i),
+            FAKE_CHAT,
+            service_message_id=i,
+            correct_emojis_number=emojis_number,
+            number_of_buttons=buttons,
+            seed=i
+        )
+
+    results = {}
+    rng = random.Random(0)
+    results["emojis.random"] = measure(lambda i: emojis.random(count=buttons, rng=rng), iterations)
+    results["captcha.init"] = measure(new_captcha, iterations)
+
+    captchas = [new_captcha(i) for i in range(iterations + 1)]
+
+    def reply_markup(i):
+        captchas[i].reply_markup = None  # build it from scratch every time
+        return captchas[i].get_reply_markup()
+
+    results["captcha.get_reply_markup"] = measure(reply_markup, iterations)
+
+    def select(i):
+        captcha = captchas[i]
+        index = i % buttons
+        captcha.emojis[index].already_selected = False  # selectable again when the same captcha is reused
+        captcha.get_emoji(index)
+        return captcha.mark_as_selected(index)
+
+    results["captcha.mark_as_selected"] = measure(select, iterations)
+
+    fake_bot = OfflineBot(admin_ids=range(10))
+    for chat_id in range(1000):
+        main.get_admin_ids(fake_bot, chat_id)
+    results["get_admin_ids.hit"] = measure(lambda i: main.get_admin_ids(fake_bot, i % 1000), iterations)
+
+    for size in args.sizes:
+        # nothing expired: the cost of going through the pending captchas every minute
+        chat_data = synthetic_chat_data(size, new_captcha)
+        context = SimpleNamespace(dispatcher=SimpleNamespace(chat_data=chat_data), bot=None)
+        sweeps = max(1, min(100, 100000 // size))
+        result = measure(lambda i: main.cleanup_and_ban(context), sweeps)
+        result["pending"] = size
+        results[f"cleanup_and_ban.{size}"] = result
+
+    print(f"micro ({iterations} iterations, sweeps over {', '.join(map(str, args.sizes))} pending captchas)")
+    for name, result in results.items():
+        print(f"  {name:<28} {result['seconds'] * 1000000:12.2f} us/op  {result['blocks']:8.1f} blocks/op  "
+              f"{result['bytes'] / 1024:8.2f} KB/op  {result['peak_bytes'] / 1024:8.2f} KB peak")
+
+    return results
+
+
+BENCHMARKS = {
+    "logging": bench_logging,
+    "golden": bench_golden,
+    "sprite": bench_sprite,
+    "micro": bench_micro,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="run the bot's benchmarks")
+    parser.add_argument("benchmarks", nargs="*", help=f"benchmarks to run: {', '.join(BENCHMARKS)} (default: all)")
+    parser.add_argument("--update-golden", action="store_true", help=f"save the rendered images to {GOLDEN_FILE}")
+    parser.add_argument("--sizes", type=int, nargs="+", default=MICRO_SIZES, help="micro: pending captchas to sweep")
+    parser.add_argument("--json", help="save the results to this file, to compare them between releases")
+    args = parser.parse_args()
+
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark: {name}")
+
+    results = {}
+    for name in args.benchmarks or BENCHMARKS:
+        results[name] = BENCHMARKS[name](args)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"results saved to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import argparse
+import random
+import statistics
+import time
+import tracemalloc
+from io import BytesIO
+
+from telegram import User, Chat
+
+from config import config
+from encoder import Formats
+from images import CaptchaImage, RenderProfile
+from layout import Layouts
+from main import EmojiCaptcha, get_emojis
+
+FAKE_CHAT = Chat(-1001234567890, Chat.SUPERGROUP)
+
+
+def fake_user(user_id: int) -> User:
+    return User(user_id, f"user{user_id}", is_bot=False, last_name="Capacity", username=f"user{user_id}")
+
+
+def new_captcha(user_id: int, emojis_number: int, buttons: int, seed: int = None) -> EmojiCaptcha:
+    captcha = EmojiCaptcha(
+        fake_user(user_id),
+        FAKE_CHAT,
+        service_message_id=user_id,
+        correct_emojis_number=emojis_number,
+        correct_emojis_threshold=min(config.captcha.image_emojis_correct_threshold or emojis_number, emojis_number),
+        number_of_buttons=buttons,
+        allowed_errors=config.captcha.allowed_errors,
+        seed=seed
+    )
+    captcha.get_reply_markup()
+
+    return captcha
+
+
+def measure_renders(background: str, profile: RenderProfile, emojis_number: int, buttons: int, samples: int, warmup: int):
+    cpu_ms, wall_ms, sizes = [], [], []
+    for i in range(warmup + samples):
+        cpu_start, wall_start = time.process_time(), time.perf_counter()
+
+        captcha = new_captcha(i, emojis_number, buttons, seed=i)
+        captcha_image = CaptchaImage.from_spec(captcha.image_spec(background, profile), catalog=get_emojis())
+        captcha_image.generate_capctha_image(BytesIO(), image_format=profile.image_format, max_bytes=profile.max_bytes)
+
+        cpu_end, wall_end = time.process_time(), time.perf_counter()
+        if i < warmup:
+            # the first renders also load the emojis catalog and warm the caches
+            continue
+
+        cpu_ms.append((cpu_end - cpu_start) * 1000)
+        wall_ms.append((wall_end - wall_start) * 1000)
+        sizes.append(captcha_image.encoded.size)
+
+    return cpu_ms, wall_ms, sizes
+
+
+def measure_pending_memory(emojis_number: int, buttons: int, count: int = 1000):
+    # memory held by pending captchas (the EmojiCaptcha objects stored in chat_data, with their keyboards)
+    pending = {}
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for user_id in range(count):
+        pending[user_id] = {"captcha": new_captcha(user_id, emojis_number, buttons)}
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    return allocated / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="estimate how many joins per second the bot can handle with a config")
+    parser.add_argument("--background", default=config.captcha.image_path, help="background image (default: image_path)")
+    parser.add_argument("--max-side", type=int, default=config.captcha.image_max_side, help="image_max_side")
+    parser.add_argument("--emojis", type=int, default=config.captcha.image_emojis, help="image_emojis")
+    parser.add_argument("--buttons", type=int, default=config.captcha.image_buttons, help="image_buttons")
+    parser.add_argument("--layout", default=config.captcha.get("image_layout", Layouts.GRID), choices=Layouts.ALL)
+    parser.add_argument("--format", default=config.captcha.get("image_format", Formats.PNG), help="image_format")
+    parser.add_argument("--max-bytes", type=int, default=config.captcha.get("image_max_bytes", 0), help="image_max_bytes")
+    parser.add_argument("--samples", type=int, default=20, help="number of captchas to render")
+    parser.add_argument("--warmup", type=int, default=3, help="renders to discard before measuring")
+    args = parser.parse_args()
+
+    random.seed(0)
+    get_emojis()
+
+    profile = RenderProfile(
+        max_side=args.max_side,
+        scale_factor=config.captcha.image_scale_factor,
+        layout=args.layout,
+        image_format=args.format,
+        max_bytes=args.max_bytes
+    )
+    print(f"background: {args.background}, emojis: {args.emojis}, buttons: {args.buttons}")
+    print(f"profile: {profile}")
+
+    cpu_ms, wall_ms, sizes = measure_renders(args.background, profile, args.emojis, args.buttons, args.samples, args.warmup)
+    cpu_median = statistics.median(cpu_ms)
+    cpu_p95 = sorted(cpu_ms)[int(len(cpu_ms) * 0.95) - 1] if len(cpu_ms) > 1 else cpu_ms[0]
+
+    print(f"cpu per captcha: {cpu_median:.1f} ms median, {cpu_p95:.1f} ms p95 (wall: {statistics.median(wall_ms):.1f} ms)")
+    print(f"image size: {statistics.mean(sizes) / 1024:.1f} KB average, {max(sizes) / 1024:.1f} KB max")
+    print(f"sustainable joins/sec per core: {1000 / cpu_median:.1f} (p95: {1000 / cpu_p95:.1f})")
+    print(f"memory per pending captcha: {measure_pending_memory(args.emojis, args.buttons) / 1024:.1f} KB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import logging
+import time
+from typing import Dict, List, Optional
+
+from telegram import Bot, Update
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+GET_UPDATES_LIMIT = 100  # max allowed by getUpdates
+
+
+def is_self_join(update: Update, bot_id: int) -> bool:
+    # a user who joined by themselves (people added by someone else don't get a captcha, see on_new_member)
+    message = update.message
+    if not message or not message.new_chat_members or not message.from_user:
+        return False
+
+    member = message.new_chat_members[0]
+    return member.id == message.from_user.id and member.id != bot_id
+
+
+class Backlog:
+    """Updates received while the bot was offline, with the joins coalesced per chat"""
+
+    def __init__(self, bot_id: int):
+        self.bot_id = bot_id
+        self.joins: Dict[int, Dict[int, Update]] = {}  # chat_id -> user_id -> latest join update
+        self.updates: List[Update] = []  # everything else, to be processed as usual
+        self.offset: Optional[int] = None  # first update_id not in the backlog
+        self.drained = 0
+        self.duplicated_joins = 0
+        self.left = 0  # users who joined and left again while the bot was offline
+        self.callback_queries = 0
+        self.seconds = 0.0
+
+    def add(self, update: Update):
+        self.drained += 1
+        message = update.message
+
+        if update.callback_query:
+            # the captchas were lost with the restart, and old queries can't be answered anyway
+            self.callback_queries += 1
+        elif is_self_join(update, self.bot_id):
+            chat_joins = self.joins.setdefault(message.chat_id, {})
+            if message.from_user.id in chat_joins:
+                self.duplicated_joins += 1
+            chat_joins[message.from_user.id] = update
+        elif message and message.left_chat_member and message.left_chat_member.id in self.joins.get(message.chat_id, {}):
+            self.joins[message.chat_id].pop(message.left_chat_member.id)
+            self.left += 1
+        else:
+            self.updates.append(update)
+
+    def joins_count(self) -> int:
+        return sum(len(chat_joins) for chat_joins in self.joins.values())
+
+    def replay(self) -> List[Update]:
+        # the coalesced joins and the other updates, in the order they were received
+        updates = self.updates + [update for chat_joins in self.joins.values() for update in chat_joins.values()]
+        return sorted(updates, key=lambda u: u.update_id)
+
+    def describe(self) -> str:
+        return f"{self.drained} updates drained in {self.seconds:.2f} seconds: {self.joins_count()} joins in " \
+               f"{len(self.joins)} chats ({self.duplicated_joins} duplicated, {self.left} left), " \
+               f"{len(self.updates)} other updates, {self.callback_queries} stale callback queries"
+
+
+def drain_backlog(bot: Bot, allowed_updates: Optional[List[str]] = None, max_updates: int = 10000) -> Backlog:
+    # fetch the pending updates in batches, without waiting for new ones. Every request confirms the previous batch,
+    # the updates past max_updates stay on Telegram's side and are received by the normal polling
+    backlog = Backlog(bot.id)
+    start = time.perf_counter()
+
+    while True:
+        updates = bot.get_updates(offset=backlog.offset, timeout=0, limit=GET_UPDATES_LIMIT, allowed_updates=allowed_updates)
+        if not updates or backlog.drained >= max_updates:
+            break
+
+        for update in updates:
+            backlog.add(update)
+        backlog.offset = updates[-1].update_id + 1
+
+    backlog.seconds = time.perf_counter() - start
+    metrics.observe("catchup.drain", backlog.seconds)
+    metrics.incr("catchup.updates", backlog.drained)
+    logger.info("backlog: %s", backlog.describe())
+
+    return backlog
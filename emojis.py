@@ -1,5 +1,13 @@
+import json
+import logging
 import os
 import random
+import threading
+from typing import NamedTuple, Optional, Dict, List, Tuple
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
 
 
 WHITE_CHECKMARK_CODEPOINT = '2705'
@@ -7,6 +15,50 @@ RED_CROSS_CODEPOINT = '274c'
 WARNING_CODEPOINT = '26a0.fe0f'
 
 
+class ButtonKind:
+    SELECT = "s"
+    ALREADY_SOLVED = "c"
+    ALREADY_ERROR = "e"
+
+    ALL = (SELECT, ALREADY_SOLVED, ALREADY_ERROR)
+
+
+NONCE_LENGTH = 4
+NONCE_ALPHABET = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+class ButtonCallback(NamedTuple):
+    kind: str
+    index: int
+    nonce: str
+    user_id: int
+
+
+def encode_callback_data(kind: str, index: int, nonce: str, user_id: int) -> str:
+    # fixed format: kind (1 char), button index (2 digits), captcha nonce (4 chars), then the user id
+    return f"{kind}{index:02d}{nonce}{user_id}"
+
+
+def decode_callback_data(data: str) -> Optional[ButtonCallback]:
+    if not data or len(data) <= 3 + NONCE_LENGTH or data[0] not in ButtonKind.ALL:
+        return None
+
+    try:
+        return ButtonCallback(data[0], int(data[1:3]), data[3:3 + NONCE_LENGTH], int(data[3 + NONCE_LENGTH:]))
+    except ValueError:
+        return None
+
+
+def is_select_callback(data) -> bool:
+    button = decode_callback_data(data) if isinstance(data, str) else None
+    return bool(button) and button.kind == ButtonKind.SELECT
+
+
+def is_already_selected_callback(data) -> bool:
+    button = decode_callback_data(data) if isinstance(data, str) else None
+    return bool(button) and button.kind in (ButtonKind.ALREADY_SOLVED, ButtonKind.ALREADY_ERROR)
+
+
 def hex_codepoint_to_unicode(hex_codepoint: str):
     return chr(int(hex_codepoint, 16))
 
@@ -75,15 +127,6 @@ class EmojiButton(Emoji):
         self.correct = correct  # if the emoji is one of the correct ones (in the image)
         super(EmojiButton, self).__init__(*args, **kwargs)
 
-    @property
-    def callback_data(self):
-        if self.already_selected and self.correct:
-            return f"button:already_solved"
-        if self.already_selected and not self.correct:
-            return f"button:already_error"
-
-        return f"button:{self.id}"
-
     @property
     def unicode(self):
         if self.already_selected and self.correct:
@@ -97,34 +140,151 @@ class EmojiButton(Emoji):
     def convert(cls, emoji: Emoji):
         return cls(emoji.origin_str)
 
-    def user_callback_data(self, user_id):
+    def user_callback_data(self, user_id: int, index: int, nonce: str):
         if self.already_selected and self.correct:
-            return f"button:already_solved:user{user_id}"
-        if self.already_selected and not self.correct:
-            return f"button:already_error:user{user_id}"
+            kind = ButtonKind.ALREADY_SOLVED
+        elif self.already_selected and not self.correct:
+            kind = ButtonKind.ALREADY_ERROR
+        else:
+            kind = ButtonKind.SELECT
+
+        return encode_callback_data(kind, index, nonce, user_id)
+
+
+class CatalogDiff(NamedTuple):
+    added: List[str]  # emoji ids
+    removed: List[str]
+    modified: List[str]
 
-        return f"button:{self.id}:user{user_id}"
+    def __bool__(self):
+        return bool(self.added or self.removed or self.modified)
 
 
 class Emojis:
     BLACKLIST = (WHITE_CHECKMARK_CODEPOINT, RED_CROSS_CODEPOINT, WARNING_CODEPOINT)  # do not use these two emojis
 
-    def __init__(self, dir_path="emojis", min_codepoints=1, max_codepoints=999):
+    def __init__(self, dir_path="emojis", min_codepoints=1, max_codepoints=999, bboxes_file=None):
+        self.dir_path = dir_path
         self.min_codepoints = min_codepoints
         self.max_codepoints = max_codepoints
         self.emojis = []
+        self.index: Dict[str, Emoji] = {}  # emoji id -> emoji
+        self.files: Dict[str, Tuple[int, int]] = {}  # file name -> (mtime_ns, size)
+        self._refresh_lock = threading.Lock()
+
+        # file name -> ((mtime_ns, size), content bounding box): computed on first use, saved to bboxes_file
+        self.bboxes: Dict[str, Tuple[Tuple[int, int], Optional[Tuple[int, int, int, int]]]] = {}
+        self.bboxes_file = bboxes_file
+        self._bboxes_changed = False
+        self.load_bboxes()
+
+        self.refresh()
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        files = {}
+        with os.scandir(self.dir_path) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".png"):
+                    continue
+
+                stat = entry.stat()
+                files[entry.name] = (stat.st_mtime_ns, stat.st_size)
+
+        return files
+
+    def _load(self, file_name) -> Optional[Emoji]:
+        emoji = Emoji(file_name.replace(".png", ""), compile=False)
+        if not self.min_codepoints <= len(emoji.codepoints_hex) <= self.max_codepoints:
+            return None
+
+        emoji.compile()
+        return emoji
+
+    def refresh(self) -> CatalogDiff:
+        # only the files whose mtime/size changed are (re)loaded, then the new index is swapped in at once:
+        # readers always see either the old or the new version of the catalog
+        with self._refresh_lock:
+            new_files = self._scan()
+
+            added = [f for f in new_files if f not in self.files]
+            removed = [f for f in self.files if f not in new_files]
+            modified = [f for f in new_files if f in self.files and new_files[f] != self.files[f]]
+
+            if not (added or removed or modified):
+                return CatalogDiff([], [], [])
+
+            index = dict(self.index)
+            diff = CatalogDiff([], [], [])
+            for file_name in removed:
+                emoji = index.pop(Emoji(file_name.replace(".png", ""), compile=False).id, None)
+                if emoji:
+                    diff.removed.append(emoji.id)
+
+            for file_name in added + modified:
+                emoji = self._load(file_name)
+                if not emoji:
+                    continue
+
+                index[emoji.id] = emoji
+                (diff.added if file_name in added else diff.modified).append(emoji.id)
+
+            for file_name in removed + modified:
+                self.bboxes.pop(file_name, None)
+
+            self.files = new_files
+            self.index = index
+            self.emojis = list(index.values())
+
+            return diff
+
+    def bbox(self, emoji: Emoji) -> Optional[Tuple[int, int, int, int]]:
+        # bounding box of the non-transparent pixels of the emoji image (None if it's fully transparent)
+        file_name = emoji.file_name
+        stat = self.files.get(file_name)
+
+        cached = self.bboxes.get(file_name)
+        if cached and cached[0] == stat:
+            return cached[1]
+
+        with Image.open(os.path.join(self.dir_path, file_name)) as img:
+            box = img.convert("RGBA").getchannel("A").getbbox()
+
+        if stat:
+            self.bboxes[file_name] = (stat, box)
+            self._bboxes_changed = True
+
+        return box
+
+    def load_bboxes(self):
+        if not self.bboxes_file:
+            return
+
+        try:
+            with open(self.bboxes_file, "r") as f:
+                saved = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+
+        for file_name, (mtime_ns, size, box) in saved.items():
+            self.bboxes[file_name] = ((mtime_ns, size), tuple(box) if box else None)
+
+    def save_bboxes(self):
+        if not self.bboxes_file or not self._bboxes_changed:
+            return
+
+        self._bboxes_changed = False
+        saved = {file_name: [stat[0], stat[1], box] for file_name, (stat, box) in list(self.bboxes.items())}
+        with open(self.bboxes_file, "w") as f:
+            json.dump(saved, f)
+
+        logger.debug("saved %d emojis bounding boxes", len(saved))
 
-        emojis = [file_name for file_name in os.listdir(dir_path)]
-        for file_name in emojis:
-            emoji = Emoji(file_name.replace(".png", ""), compile=False)
-            if self.min_codepoints <= len(emoji.codepoints_hex) <= self.max_codepoints:
-                emoji.compile()
-            else:
-                continue
+    def get(self, emoji_id: str) -> Optional[Emoji]:
+        return self.index.get(emoji_id)
 
-            self.emojis.append(emoji)
+    def random(self, count=1, min_codepoints=1, max_codepoints=999, rng: Optional[random.Random] = None):
+        rng = rng or random
 
-    def random(self, count=1, min_codepoints=1, max_codepoints=999):
         if count > len(self.emojis):
             raise ValueError(f"number of emojis to return can't be greater than total ({len(self.emojis)})")
 
@@ -134,14 +294,15 @@ class Emojis:
         if self.max_codepoints > max_codepoints:
             raise ValueError(f"passed max_codepoints is lower than the original max_codepoints value ({max_codepoints}, {self.max_codepoints})")
 
+        emojis = self.emojis  # the list might be swapped by refresh() in the meantime
         if count == 1:
-            return random.choice(self.emojis)
+            return rng.choice(emojis)
 
         random_emojis = []
         attempts = 0
         while len(random_emojis) < count:
             attempts += 1
-            emoji = random.choice(self.emojis)
+            emoji = rng.choice(emojis)
             if emoji not in random_emojis and emoji.id not in self.BLACKLIST:
                 if min_codepoints <= len(emoji.codepoints_hex) <= max_codepoints:
                     random_emojis.append(emoji)
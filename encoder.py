@@ -0,0 +1,127 @@
+import logging
+import time
+from io import BytesIO
+from typing import NamedTuple, Optional, List
+
+from PIL import Image, features
+
+logger = logging.getLogger(__name__)
+
+
+class Formats:
+    PNG = "png"  # lossless, full colour (the largest)
+    PNG8 = "png8"  # palette-quantized png
+    JPEG = "jpeg"
+    WEBP = "webp"
+    AUTO = "auto"  # the first lossy format that fits the budget, or the smallest one
+
+    LOSSY = (JPEG, WEBP)
+    AUTO_ORDER = (JPEG, WEBP, PNG8)
+
+
+class EncodedImage(NamedTuple):
+    data: bytes
+    format: str
+    quality: Optional[int]
+    seconds: float  # total time spent encoding, including the discarded attempts
+    attempts: int
+
+    @property
+    def size(self):
+        return len(self.data)
+
+
+def _save(img: Image.Image, image_format: str, quality: Optional[int] = None) -> bytes:
+    buffer = BytesIO()
+    if image_format == Formats.PNG:
+        img.save(buffer, format="PNG")
+    elif image_format == Formats.PNG8:
+        img.convert("RGB").quantize(colors=256).save(buffer, format="PNG", optimize=True)
+    elif image_format == Formats.JPEG:
+        img.convert("RGB").save(buffer, format="JPEG", quality=quality, optimize=True)
+    elif image_format == Formats.WEBP:
+        img.convert("RGB").save(buffer, format="WEBP", quality=quality, method=4)
+    else:
+        raise ValueError(f"invalid image format: {image_format}")
+
+    return buffer.getvalue()
+
+
+def available_formats() -> List[str]:
+    formats = [Formats.JPEG, Formats.PNG8]
+    if features.check("webp"):
+        formats.insert(1, Formats.WEBP)
+
+    return formats
+
+
+def search_quality(img: Image.Image, image_format: str, max_bytes: int, min_quality: int, max_quality: int):
+    # binary search of the highest quality that fits the budget. Returns (data, quality, attempts, fits),
+    # data is the smallest attempt if nothing fits (fits is False then)
+    data = _save(img, image_format, max_quality)
+    if len(data) <= max_bytes:
+        # most images fit at the highest quality: one attempt only
+        return data, max_quality, 1, True
+
+    best = None
+    smallest = (data, max_quality)
+    attempts = 1
+    low, high = min_quality, max_quality - 1
+    while low <= high:
+        quality = (low + high) // 2
+        data = _save(img, image_format, quality)
+        attempts += 1
+
+        if len(data) < len(smallest[0]):
+            smallest = (data, quality)
+
+        if len(data) <= max_bytes:
+            best = (data, quality)
+            low = quality + 1
+        else:
+            high = quality - 1
+
+    data, quality = best or smallest
+    return data, quality, attempts, best is not None
+
+
+def encode_image(
+        img: Image.Image,
+        image_format: str = Formats.PNG,
+        max_bytes: int = 0,  # 0: no budget
+        min_quality: int = 40,
+        max_quality: int = 90
+) -> EncodedImage:
+    start = time.perf_counter()
+
+    if image_format == Formats.AUTO:
+        candidates = [f for f in Formats.AUTO_ORDER if f in available_formats()]
+    else:
+        candidates = [image_format]
+
+    if not max_bytes:
+        # no budget: use the best quality of the first candidate
+        quality = max_quality if candidates[0] in Formats.LOSSY else None
+        data = _save(img, candidates[0], quality)
+        return EncodedImage(data, candidates[0], quality, time.perf_counter() - start, 1)
+
+    smallest = None
+    attempts = 0
+    for candidate in candidates:
+        if candidate in Formats.LOSSY:
+            data, quality, candidate_attempts, fits = search_quality(img, candidate, max_bytes, min_quality, max_quality)
+            attempts += candidate_attempts
+        else:
+            data, quality = _save(img, candidate), None
+            attempts += 1
+            fits = len(data) <= max_bytes
+
+        if fits:
+            return EncodedImage(data, candidate, quality, time.perf_counter() - start, attempts)
+
+        if not smallest or len(data) < len(smallest[0]):
+            smallest = (data, candidate, quality)
+
+    logger.debug("no format fits the budget of %d bytes, using the smallest result", max_bytes)
+    data, candidate, quality = smallest
+    return EncodedImage(data, candidate, quality, time.perf_counter() - start, attempts)
@@ -0,0 +1,89 @@
+import logging
+import threading
+from typing import Dict, Optional
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class OverflowPolicies:
+    EVICT_OLDEST = "evict_oldest"  # drop the oldest pending captcha of the chat (its user stays muted)
+    BAN = "ban"  # ban the new member without sending a captcha
+    MUTE = "mute"  # mute the new member without sending a captcha
+
+    ALL = (EVICT_OLDEST, BAN, MUTE)
+
+
+class PendingCaptchas:
+    """Cheap counters of the pending captchas, per chat and in total"""
+
+    def __init__(self, max_per_chat: int = 200, max_total: int = 5000, overflow_policy: str = OverflowPolicies.EVICT_OLDEST):
+        if overflow_policy not in OverflowPolicies.ALL:
+            raise ValueError(f"invalid overflow policy: {overflow_policy}")
+
+        self.max_per_chat = max_per_chat
+        self.max_total = max_total
+        self.overflow_policy = overflow_policy
+
+        self._lock = threading.Lock()
+        self.per_chat: Dict[int, int] = {}
+        self.total = 0
+
+    def added(self, chat_id: int):
+        with self._lock:
+            self.per_chat[chat_id] = self.per_chat.get(chat_id, 0) + 1
+            self.total += 1
+
+        metrics.set_gauge("pending.total", self.total)
+
+    def removed(self, chat_id: int):
+        with self._lock:
+            count = self.per_chat.get(chat_id, 0) - 1
+            if count > 0:
+                self.per_chat[chat_id] = count
+            else:
+                self.per_chat.pop(chat_id, None)
+            self.total = max(0, self.total - 1)
+
+        metrics.set_gauge("pending.total", self.total)
+
+    def count(self, chat_id: int) -> int:
+        return self.per_chat.get(chat_id, 0)
+
+    def overflow(self, chat_id: int) -> Optional[str]:
+        # the policy to apply if there's no room for another captcha in the chat, None otherwise
+        chat_full = self.max_per_chat and self.count(chat_id) >= self.max_per_chat
+        total_full = self.max_total and self.total >= self.max_total
+        if not (chat_full or total_full):
+            return None
+
+        metrics.incr(f"pending.overflow.{self.overflow_policy}")
+        logger.warning("too many pending captchas (chat %d: %d, total: %d): %s",
+                       chat_id, self.count(chat_id), self.total, self.overflow_policy)
+
+        if self.overflow_policy == OverflowPolicies.EVICT_OLDEST and not self.count(chat_id):
+            # the limit is the global one and this chat has nothing to evict
+            return OverflowPolicies.MUTE
+
+        return self.overflow_policy
+
+
+class InFlight:
+    """Keys (eg. (chat_id, user_id)) being processed right now, to drop concurrent duplicates"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = set()
+
+    def claim(self, key) -> bool:
+        # False if the key is already being processed
+        with self._lock:
+            if key in self._keys:
+                return False
+            self._keys.add(key)
+            return True
+
+    def release(self, key):
+        with self._lock:
+            self._keys.discard(key)
@@ -1,101 +1,175 @@
 import logging
 import math
 import os
-from random import randint, choice
+import threading
+from collections import deque, OrderedDict
+import random
 from pathlib import Path
-from typing import List
+from typing import List, NamedTuple, Dict, Hashable, Deque, Optional, Tuple
 
 from PIL import Image
 
-from emojis import EmojiButton
+from emojis import Emoji, EmojiButton, Emojis
+from encoder import encode_image, EncodedImage, Formats
+from layout import gen_offsets, Layouts
 
 logger = logging.getLogger(__name__)
-logger_geom = logging.getLogger("geometry")
 
 
-def gen_offsets_grid(img_width: int, img_height: int, number_of_emojis: int, cell_padding: int = 10):
-    # side_1 is always equal or greater than side_2
-    side_1, side_2 = 1, 1
-    while True:
-        if side_1 * side_2 >= number_of_emojis:
-            break
-        else:
-            if side_1 <= side_2:
-                # side_1 should always be equal or greater than side_2
-                side_1 += 1
-            else:
-                side_2 += 1
+def transform_sprite(sprite: Image.Image, angle: float, size: int) -> Image.Image:
+    # rotate 'sprite' by 'angle' degrees (counter clockwise, like Image.rotate) and fit its rotated bounds
+    # in a size x size square, using one affine transform: a single resampling pass, no intermediate images
+    # and no clipped corners
+    radians = math.radians(angle)
+    cos, sin = math.cos(radians), math.sin(radians)
 
-    if img_width >= img_height:
-        grid_x, grid_y = side_1, side_2
-    else:
-        grid_y, grid_x = side_1, side_2
+    w, h = sprite.size
+    scale = size / max(abs(w * cos) + abs(h * sin), abs(w * sin) + abs(h * cos))
+    if scale < 0.5:
+        # the affine transform doesn't prefilter: shrink by an integer factor first (a cheap box filter), so that
+        # bicubic only has to scale by ~0.75, or small emojis (reduced/minimal modes) would alias
+        sprite = sprite.reduce(max(1, round(0.75 / scale)))
+        w, h = sprite.size
 
-    logger_geom.debug(f"grid size for {number_of_emojis} emojis: {grid_x}x{grid_y}")
+    rotated_w = abs(w * cos) + abs(h * sin)
+    rotated_h = abs(w * sin) + abs(h * cos)
+    scale = size / max(rotated_w, rotated_h)
+    out_w = max(1, round(rotated_w * scale))
+    out_h = max(1, round(rotated_h * scale))
 
-    cell_w = math.floor(img_width / grid_x)
-    cell_h = math.floor(img_height / grid_y)
-    logger_geom.debug(f"cells side (width: {img_width}): {grid_x} x {cell_w} = {grid_x*cell_w}")
-    logger_geom.debug(f"cells side (height: {img_height}): {grid_y} x {cell_h} = {grid_y*cell_h}")
+    # Image.transform needs the inverse matrix: for every output pixel, the input pixel to sample.
+    # output -> centered output -> unscaled -> unrotated -> input
+    out_cx, out_cy = out_w / 2, out_h / 2
+    in_cx, in_cy = w / 2, h / 2
+    a, b = cos / scale, -sin / scale
+    d, e = sin / scale, cos / scale
+    c = in_cx - a * out_cx - b * out_cy
+    f = in_cy - d * out_cx - e * out_cy
 
-    emoji_w = cell_w - (cell_padding * 2)
-    emoji_h = cell_h - (cell_padding * 2)
-    logger_geom.debug(f"emojis size: {emoji_w} x {emoji_h}")
+    return sprite.transform((out_w, out_h), Image.AFFINE, (a, b, c, d, e, f), resample=Image.BICUBIC)
 
-    coordinates = []
-    for x in range(grid_x):
-        for y in range(grid_y):
-            offset_x = (cell_w * x) + cell_padding
-            offset_y = (cell_h * y) + cell_padding
 
-            logger_geom.debug(f"cell {x+1}x{y+1}: {offset_x:3}, {offset_y:3}")
+class RenderProfile(NamedTuple):
+    max_side: int = 512
+    scale_factor: float = 0.0
+    layout: str = Layouts.GRID
+    image_format: str = Formats.PNG
+    max_bytes: int = 0
 
-            coordinates.append((offset_x, offset_y))
 
-        # logger.debug("")
+def load_background(background_path, max_side=0, scale_factor=0.0) -> Image.Image:
+    bg_img = Image.open(background_path, 'r').convert('RGBA')
 
-    return coordinates, (emoji_w, emoji_h)
+    resize_to = None
+    if max_side:
+        size = bg_img.size
+        largest_side = size[0] if size[0] > size[1] else size[1]
 
+        logger.debug("max side: %d, largest side: %d", max_side, largest_side)
 
-class CaptchaImage:
-    def __init__(self, background_path, emojis_list: List[EmojiButton], scale_factor=0, max_side=0):
-        self.bg_img = Image.open(background_path, 'r').convert('RGBA')
+        if largest_side <= max_side:
+            resize_to = size
+        else:
+            rateo = round(max_side / largest_side, 4)
+            resize_to = (int(size[0] * rateo), int(size[1] * rateo))
+    if scale_factor:
+        size = bg_img.size
+        resize_to = (int(size[0] * scale_factor), int(size[1] * scale_factor))
+
+    if resize_to:
+        logger.debug('resizing to: %s', resize_to)
+        bg_img = bg_img.resize(resize_to, Image.ANTIALIAS)
+
+    return bg_img
+
+
+class BackgroundCache:
+    """Decoded and resized backgrounds, least recently used first out when over the memory budget"""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._lock = threading.Lock()
+        self._images: "OrderedDict[Tuple, Image.Image]" = OrderedDict()
 
-        resize_to = None
-        if max_side:
-            size = self.bg_img.size
-            largest_side = size[0] if size[0] > size[1] else size[1]
+    def get(self, background_path, max_side=0, scale_factor=0.0) -> Image.Image:
+        # the returned image is shared: copy it before drawing on it
+        stat = os.stat(background_path)
+        key = (str(background_path), stat.st_mtime_ns, stat.st_size, max_side, scale_factor)
+        with self._lock:
+            bg_img = self._images.get(key)
+            if bg_img is not None:
+                self._images.move_to_end(key)
+                return bg_img
 
-            logger.debug("max side: %d, largest side: %d", max_side, largest_side)
+        bg_img = load_background(background_path, max_side, scale_factor)
+        with self._lock:
+            if key not in self._images:
+                self._images[key] = bg_img
+                self.size += bg_img.width * bg_img.height * len(bg_img.mode)
+            while self.size > self.max_bytes and len(self._images) > 1:
+                _, evicted = self._images.popitem(last=False)
+                self.size -= evicted.width * evicted.height * len(evicted.mode)
 
-            if largest_side <= max_side:
-                resize_to = size
-            else:
-                rateo = round(max_side / largest_side, 4)
-                resize_to = (int(size[0] * rateo), int(size[1] * rateo))
-        if scale_factor:
-            size = self.bg_img.size
-            resize_to = (int(size[0] * scale_factor), int(size[1] * scale_factor))
+        return bg_img
 
-        if resize_to:
-            logger.debug('resizing to: %s', resize_to)
-            self.bg_img = self.bg_img.resize(resize_to, Image.ANTIALIAS)
+    def __len__(self):
+        return len(self._images)
+
+
+class CaptchaSpec(NamedTuple):
+    # everything needed to render a captcha image: rendering the same spec always produces the same image
+    seed: int
+    emoji_ids: Tuple[str, ...]
+    background: str  # background key (its path)
+    profile: RenderProfile = RenderProfile()
+
+
+class CaptchaImage:
+    def __init__(self, background_path, emojis_list: List[EmojiButton], scale_factor=0, max_side=0,
+                 layout=Layouts.GRID, rng: Optional[random.Random] = None, catalog: Optional[Emojis] = None,
+                 backgrounds: Optional[BackgroundCache] = None):
+        self.rng = rng or random.Random()
+        if backgrounds:
+            # the emojis are pasted on the image: don't touch the cached one
+            self.bg_img = backgrounds.get(background_path, max_side, scale_factor).copy()
+        else:
+            self.bg_img = load_background(background_path, max_side, scale_factor)
 
         self.png_files_path = []
         self.result_file_path = None
+        self.encoded: Optional[EncodedImage] = None
 
+        self.crop_boxes = []  # content bounding box of every emoji, if the catalog is available
         for emoji in emojis_list:
             png_image_path = Path("emojis/") / emoji.file_name
             self.png_files_path.append(png_image_path)
+            self.crop_boxes.append(catalog.bbox(emoji) if catalog else None)
 
         self.number_of_emojis = len(emojis_list)
+        self.layout = layout
+
+    @classmethod
+    def from_spec(cls, spec: CaptchaSpec, catalog: Optional[Emojis] = None, backgrounds: Optional[BackgroundCache] = None):
+        return cls(
+            background_path=spec.background,
+            emojis_list=[EmojiButton(emoji_id.replace(".", "-")) for emoji_id in spec.emoji_ids],
+            scale_factor=spec.profile.scale_factor,
+            max_side=spec.profile.max_side,
+            layout=spec.profile.layout,
+            rng=random.Random(spec.seed),
+            catalog=catalog,
+            backgrounds=backgrounds
+        )
 
-    def generate_capctha_image(self, file_path):
+    def generate_capctha_image(self, file_path, image_format=Formats.PNG, max_bytes=0):
         bg_w, bg_h = self.bg_img.size
-        coordinates, (emoji_width, emoji_height) = gen_offsets_grid(
+        coordinates, (emoji_width, emoji_height) = gen_offsets(
             bg_w, bg_h,
             number_of_emojis=self.number_of_emojis,
-            cell_padding=10
+            cell_padding=10,
+            layout=self.layout,
+            rng=self.rng
         )
 
         for i, (x, y) in enumerate(coordinates):
@@ -107,29 +181,91 @@ class CaptchaImage:
             png_image_path = self.png_files_path[i]
             png_img = Image.open(png_image_path).convert('RGBA')
 
-            # rotate emoji
+            crop_box = self.crop_boxes[i]
+            if crop_box:
+                # drop the transparent margins before transforming the emoji: fewer pixels to process,
+                # and the visible emoji fills its cell
+                png_img = png_img.crop(crop_box)
+
             # rotation might cause the emojis to slightly overlap in the grid, but shouldn't be an issue
-            rotations = (randint(20, 90), randint(290, 360))
-            png_img = png_img.rotate(choice(rotations))
+            rotations = (self.rng.randint(20, 90), self.rng.randint(290, 360))
+            angle = self.rng.choice(rotations)
 
-            # resize emoji
-            new_emoji_size = randint(
+            new_emoji_size = self.rng.randint(
                 # make sure to pass the smaller first
                 emoji_width if emoji_width <= emoji_height else emoji_height,
                 emoji_width if emoji_width > emoji_height else emoji_height,
             )
-            png_img = png_img.resize((new_emoji_size, new_emoji_size), Image.ANTIALIAS)
+
+            # rotate and resize with a single resampling pass
+            png_img = transform_sprite(png_img, angle, new_emoji_size)
+            x += (new_emoji_size - png_img.width) // 2
+            y += (new_emoji_size - png_img.height) // 2
 
             self.bg_img.paste(png_img, (x, y), png_img)  # https://stackoverflow.com/a/5324782
 
-        self.bg_img.save(file_path)
+        self.encoded = encode_image(self.bg_img, image_format=image_format, max_bytes=max_bytes)
+        logger.debug("encoded captcha: %s (quality: %s), %d bytes in %.1f ms",
+                     self.encoded.format, self.encoded.quality, self.encoded.size, self.encoded.seconds * 1000)
+
+        if isinstance(file_path, (str, Path)):
+            with open(file_path, "wb") as f:
+                f.write(self.encoded.data)
+        else:
+            # file-like object
+            file_path.write(self.encoded.data)
 
         self.result_file_path = file_path
         return file_path
 
     def delete_generated_image(self):
+        if not isinstance(self.result_file_path, (str, Path)):
+            return
+
         try:
             os.remove(self.result_file_path)
         except FileNotFoundError:
             pass
 
+
+class PooledRender(NamedTuple):
+    emojis_list: List[Emoji]
+    image_bytes: bytes
+
+
+class RenderPool:
+    """Recently rendered captcha images, reused when the bot is under load"""
+
+    def __init__(self, size_per_key=20):
+        self.size_per_key = size_per_key
+        self._lock = threading.Lock()
+        self._renders: Dict[Hashable, Deque[PooledRender]] = {}
+
+    def add(self, key: Hashable, emojis_list: List[Emoji], image_bytes: bytes):
+        with self._lock:
+            renders = self._renders.setdefault(key, deque(maxlen=self.size_per_key))
+            renders.append(PooledRender(list(emojis_list), image_bytes))
+
+    def get(self, key: Hashable) -> Optional[PooledRender]:
+        with self._lock:
+            renders = self._renders.get(key)
+            if not renders:
+                return None
+
+            return random.choice(renders)
+
+    def discard_emojis(self, emoji_ids: List[str]) -> int:
+        # drop the renders that contain any of these emojis (eg. because their image changed)
+        emoji_ids = set(emoji_ids)
+        discarded = 0
+        with self._lock:
+            for key, renders in self._renders.items():
+                keep = [r for r in renders if not any(e.id in emoji_ids for e in r.emojis_list)]
+                discarded += len(renders) - len(keep)
+                self._renders[key] = deque(keep, maxlen=self.size_per_key)
+
+        return discarded
+
+    def __len__(self):
+        return sum(len(renders) for renders in self._renders.values())
+
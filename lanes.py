@@ -0,0 +1,203 @@
+import logging
+import threading
+import time
+from collections import deque
+from typing import Dict, Deque, Sequence, Tuple, Any, List, Hashable
+
+from telegram import Update
+from telegram.ext import Dispatcher
+
+from api import retry_deadline
+from metrics import metrics
+from sharding import update_routing_key
+
+logger = logging.getLogger(__name__)
+
+
+class Lanes:
+    FAST = "fast"  # callback queries: users solving a captcha, Telegram expects a quick answer
+    BULK = "bulk"  # joins (captcha renders) and commands
+
+    ALL = (FAST, BULK)
+
+
+# seconds a handler can wait for flood limits and retries: waiting longer would stall the whole lane
+LANE_RETRY_DEADLINE = {
+    Lanes.FAST: 3,
+    Lanes.BULK: 15,
+}
+
+
+class Policies:
+    STRICT = "strict"  # one thread per lane: the fast lane never waits for the bulk lane
+    WEIGHTED = "weighted"  # one thread serving up to 'fast_weight' fast updates for every bulk update
+
+    ALL = (STRICT, WEIGHTED)
+
+
+def update_lane(update: Update) -> str:
+    if update.callback_query:
+        return Lanes.FAST
+
+    return Lanes.BULK
+
+
+class FairQueue:
+    """Deficit round robin between keys (chats): a key with many items waiting can't delay the other keys' items"""
+
+    def __init__(self, quantum: int = 1):
+        self.quantum = max(1, quantum)  # items of a key served in a row when other keys are waiting
+        self.queues: Dict[Hashable, Deque] = {}
+        self.active: Deque[Hashable] = deque()  # keys with items waiting, in round robin order
+        self.deficit: Dict[Hashable, int] = {}
+        self._length = 0
+
+    def append(self, key: Hashable, item):
+        key_queue = self.queues.get(key)
+        if key_queue is None:
+            key_queue = self.queues[key] = deque()
+            self.active.append(key)
+            self.deficit[key] = 0
+        key_queue.append(item)
+        self._length += 1
+
+    def popleft(self) -> Tuple[Hashable, Any]:
+        if not self.active:
+            raise IndexError("pop from an empty FairQueue")
+
+        key = self.active[0]
+        if not self.deficit[key]:
+            self.deficit[key] = self.quantum
+
+        key_queue = self.queues[key]
+        item = key_queue.popleft()
+        self.deficit[key] -= 1
+        self._length -= 1
+
+        if not key_queue:
+            # idle keys don't keep their turn nor their deficit
+            self.active.popleft()
+            del self.queues[key]
+            del self.deficit[key]
+        elif not self.deficit[key]:
+            self.active.rotate(-1)
+
+        return key, item
+
+    def depth(self, key: Hashable) -> int:
+        key_queue = self.queues.get(key)
+        return len(key_queue) if key_queue else 0
+
+    def __len__(self):
+        return self._length
+
+
+class LaneScheduler:
+    def __init__(self, policy: str = Policies.STRICT, fast_weight: int = 4, chat_quantum: int = 1):
+        if policy not in Policies.ALL:
+            raise ValueError(f"invalid lanes policy: {policy}")
+
+        self.policy = policy
+        self.fast_weight = max(1, fast_weight)
+        self._condition = threading.Condition()
+        # items are (enqueued_at, whether the chat had nothing else waiting, item)
+        self._lanes: Dict[str, FairQueue] = {lane: FairQueue(chat_quantum) for lane in Lanes.ALL}
+        self._fast_streak = 0  # fast updates served in a row while the bulk lane was waiting
+
+    def put(self, lane: str, item, key: Hashable = 0):
+        with self._condition:
+            quiet = not self._lanes[lane].depth(key)
+            self._lanes[lane].append(key, (time.monotonic(), quiet, item))
+            metrics.set_gauge(f"lanes.{lane}.depth", len(self._lanes[lane]))
+            metrics.set_gauge(f"lanes.{lane}.chats", len(self._lanes[lane].queues))
+            self._condition.notify_all()
+
+    def _pick(self, lanes: Sequence[str]):
+        fast = self._lanes[Lanes.FAST] if Lanes.FAST in lanes else None
+        bulk = self._lanes[Lanes.BULK] if Lanes.BULK in lanes else None
+
+        if fast and (not bulk or self._fast_streak < self.fast_weight):
+            self._fast_streak = self._fast_streak + 1 if bulk else 0
+            return Lanes.FAST
+        if bulk:
+            self._fast_streak = 0
+            return Lanes.BULK
+
+        return None
+
+    def get(self, lanes: Sequence[str]):
+        with self._condition:
+            while True:
+                lane = self._pick(lanes)
+                if lane:
+                    break
+                self._condition.wait()
+
+            _, (enqueued_at, quiet, item) = self._lanes[lane].popleft()
+            metrics.set_gauge(f"lanes.{lane}.depth", len(self._lanes[lane]))
+            metrics.set_gauge(f"lanes.{lane}.chats", len(self._lanes[lane].queues))
+
+        wait = time.monotonic() - enqueued_at
+        metrics.observe(f"lanes.{lane}.wait", wait)
+        # the wait of updates from chats with nothing else queued should stay flat while another chat is raided
+        metrics.observe(f"lanes.{lane}.wait.{'quiet' if quiet else 'busy'}", wait)
+        return lane, item
+
+    def depth(self, lane: str) -> int:
+        return len(self._lanes[lane])
+
+    def busiest_chats(self, lane: str, top: int = 5) -> List[Tuple[Hashable, int, float]]:
+        # (chat, updates waiting, seconds the oldest one has been waiting) of the chats with the most updates waiting
+        now = time.monotonic()
+        with self._condition:
+            chats = [(key, len(key_queue), now - key_queue[0][0]) for key, key_queue in self._lanes[lane].queues.items()]
+
+        return sorted(chats, key=lambda c: c[1], reverse=True)[:top]
+
+
+class LaneDispatcher(Dispatcher):
+    """Dispatcher that processes updates in priority lanes instead of the order they arrive"""
+
+    def __init__(self, *args, lanes_policy: str = Policies.STRICT, fast_weight: int = 4, chat_quantum: int = 1, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.scheduler = LaneScheduler(lanes_policy, fast_weight, chat_quantum)
+        self._lane_threads = []
+        self._lane_threads_lock = threading.Lock()
+
+    def _start_lane_threads(self):
+        with self._lane_threads_lock:
+            if self._lane_threads:
+                return
+
+            if self.scheduler.policy == Policies.STRICT:
+                thread_lanes = [(Lanes.FAST,), (Lanes.BULK,)]
+            else:
+                thread_lanes = [Lanes.ALL]
+
+            for lanes in thread_lanes:
+                thread = threading.Thread(
+                    target=self._run_lanes,
+                    args=(lanes,),
+                    name=f"lane-{'-'.join(lanes)}",
+                    daemon=True
+                )
+                thread.start()
+                self._lane_threads.append(thread)
+
+            logger.debug("started %d lane threads (policy: %s)", len(self._lane_threads), self.scheduler.policy)
+
+    def _run_lanes(self, lanes: Sequence[str]):
+        while True:
+            lane, update = self.scheduler.get(lanes)
+            with metrics.timer(f"lanes.{lane}.process"), retry_deadline(time.monotonic() + LANE_RETRY_DEADLINE[lane]):
+                super().process_update(update)
+
+    def process_update(self, update):
+        if not isinstance(update, Update):
+            # errors and custom objects are processed right away
+            return super().process_update(update)
+
+        self._start_lane_threads()
+        # each lane is shared fairly between the chats
+        self.scheduler.put(update_lane(update), update, key=update_routing_key(update))
@@ -0,0 +1,167 @@
+import logging
+import math
+import random
+from functools import lru_cache
+from typing import List, Tuple, Optional
+
+logger = logging.getLogger(__name__)
+logger_geom = logging.getLogger("geometry")
+
+JITTER_SCALE = 0.8  # emojis side (relative to the grid cell) when using the jittered grid
+POISSON_SCALE = 0.7  # emojis side (relative to the grid cell) when placing emojis at random
+POISSON_ATTEMPTS = 30  # candidates to try for every emoji before falling back to the jittered grid
+
+
+class Layouts:
+    GRID = "grid"
+    JITTERED_GRID = "jittered"
+    POISSON = "poisson"
+
+    ALL = (GRID, JITTERED_GRID, POISSON)
+
+
+@lru_cache(maxsize=256)
+def grid_geometry(img_width: int, img_height: int, number_of_emojis: int, cell_padding: int = 10):
+    # memoized: the geometry only depends on the arguments, so most captchas don't need to compute it again
+
+    # side_1 is always equal or greater than side_2
+    side_1, side_2 = 1, 1
+    while True:
+        if side_1 * side_2 >= number_of_emojis:
+            break
+        else:
+            if side_1 <= side_2:
+                # side_1 should always be equal or greater than side_2
+                side_1 += 1
+            else:
+                side_2 += 1
+
+    if img_width >= img_height:
+        grid_x, grid_y = side_1, side_2
+    else:
+        grid_y, grid_x = side_1, side_2
+
+    logger_geom.debug("grid size for %d emojis: %dx%d", number_of_emojis, grid_x, grid_y)
+
+    cell_w = math.floor(img_width / grid_x)
+    cell_h = math.floor(img_height / grid_y)
+    logger_geom.debug("cells side (width: %d): %d x %d = %d", img_width, grid_x, cell_w, grid_x * cell_w)
+    logger_geom.debug("cells side (height: %d): %d x %d = %d", img_height, grid_y, cell_h, grid_y * cell_h)
+
+    emoji_w = cell_w - (cell_padding * 2)
+    emoji_h = cell_h - (cell_padding * 2)
+    logger_geom.debug("emojis size: %d x %d", emoji_w, emoji_h)
+
+    log_cells = logger_geom.isEnabledFor(logging.DEBUG)
+    coordinates = []
+    for x in range(grid_x):
+        for y in range(grid_y):
+            offset_x = (cell_w * x) + cell_padding
+            offset_y = (cell_h * y) + cell_padding
+
+            if log_cells:
+                logger_geom.debug("cell %dx%d: %3d, %3d", x + 1, y + 1, offset_x, offset_y)
+
+            coordinates.append((offset_x, offset_y))
+
+    return tuple(coordinates), (cell_w, cell_h), (emoji_w, emoji_h)
+
+
+def gen_offsets_grid(img_width: int, img_height: int, number_of_emojis: int, cell_padding: int = 10):
+    coordinates, _, emoji_size = grid_geometry(img_width, img_height, number_of_emojis, cell_padding)
+
+    return list(coordinates), emoji_size
+
+
+def gen_offsets_jittered_grid(img_width: int, img_height: int, number_of_emojis: int, cell_padding: int = 10,
+                              rng: Optional[random.Random] = None):
+    rng = rng or random
+    coordinates, _, (emoji_w, emoji_h) = grid_geometry(img_width, img_height, number_of_emojis, cell_padding)
+
+    # emojis are smaller than the cell, so they can be moved around inside it without overlapping
+    emoji_side = max(1, int(min(emoji_w, emoji_h) * JITTER_SCALE))
+    slack_x = max(0, emoji_w - emoji_side)
+    slack_y = max(0, emoji_h - emoji_side)
+
+    jittered = [(x + rng.randint(0, slack_x), y + rng.randint(0, slack_y)) for x, y in coordinates]
+
+    return jittered, (emoji_side, emoji_side)
+
+
+@lru_cache(maxsize=256)
+def poisson_geometry(img_width: int, img_height: int, number_of_emojis: int, cell_padding: int = 10):
+    _, _, (emoji_w, emoji_h) = grid_geometry(img_width, img_height, number_of_emojis, cell_padding)
+
+    emoji_side = max(1, int(min(emoji_w, emoji_h) * POISSON_SCALE))
+
+    # minimum distance between the top-left corners of two emojis (Chebyshev distance, emojis are squares).
+    # It's also the side of the spatial hash cells: two points in the same hash cell would always be too close,
+    # so every hash cell contains at most one point and we only have to check the 3x3 neighbourhood
+    min_distance = emoji_side + cell_padding
+
+    max_x = img_width - emoji_side - cell_padding
+    max_y = img_height - emoji_side - cell_padding
+
+    logger_geom.debug("poisson geometry for %d emojis: side %d, min distance %d, domain %dx%d",
+                      number_of_emojis, emoji_side, min_distance, max_x, max_y)
+
+    return emoji_side, min_distance, (max_x, max_y)
+
+
+def gen_offsets_poisson(img_width: int, img_height: int, number_of_emojis: int, cell_padding: int = 10,
+                        rng: Optional[random.Random] = None):
+    rng = rng or random
+    emoji_side, min_distance, (max_x, max_y) = poisson_geometry(img_width, img_height, number_of_emojis, cell_padding)
+
+    if max_x < cell_padding or max_y < cell_padding:
+        logger.debug("image too small to place emojis at random, falling back to the jittered grid")
+        return gen_offsets_jittered_grid(img_width, img_height, number_of_emojis, cell_padding, rng=rng)
+
+    spatial_hash = {}
+    coordinates = []
+    for _ in range(number_of_emojis):
+        for _ in range(POISSON_ATTEMPTS):
+            x = rng.randint(cell_padding, max_x)
+            y = rng.randint(cell_padding, max_y)
+            hash_x, hash_y = x // min_distance, y // min_distance
+
+            valid = True
+            for neighbour_x in range(hash_x - 1, hash_x + 2):
+                for neighbour_y in range(hash_y - 1, hash_y + 2):
+                    point = spatial_hash.get((neighbour_x, neighbour_y))
+                    if point and abs(point[0] - x) < min_distance and abs(point[1] - y) < min_distance:
+                        valid = False
+                        break
+
+                if not valid:
+                    break
+
+            if valid:
+                spatial_hash[(hash_x, hash_y)] = (x, y)
+                coordinates.append((x, y))
+                break
+        else:
+            # the number of attempts is bounded, so this always terminates
+            logger.debug("couldn't place emoji %d after %d attempts, falling back to the jittered grid",
+                         len(coordinates) + 1, POISSON_ATTEMPTS)
+            return gen_offsets_jittered_grid(img_width, img_height, number_of_emojis, cell_padding, rng=rng)
+
+    return coordinates, (emoji_side, emoji_side)
+
+
+def gen_offsets(
+        img_width: int,
+        img_height: int,
+        number_of_emojis: int,
+        cell_padding: int = 10,
+        layout: str = Layouts.GRID,
+        rng: Optional[random.Random] = None
+) -> Tuple[List[Tuple[int, int]], Tuple[int, int]]:
+    if layout == Layouts.GRID:
+        return gen_offsets_grid(img_width, img_height, number_of_emojis, cell_padding)
+    elif layout == Layouts.JITTERED_GRID:
+        return gen_offsets_jittered_grid(img_width, img_height, number_of_emojis, cell_padding, rng=rng)
+    elif layout == Layouts.POISSON:
+        return gen_offsets_poisson(img_width, img_height, number_of_emojis, cell_padding, rng=rng)
+
+    raise ValueError(f"invalid layout: {layout}")
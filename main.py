@@ -1,33 +1,131 @@
+import atexit
 import datetime
+import hashlib
 import json
 import logging
 import logging.config
+import multiprocessing
 import os
+import queue
 import random
 import re
-from functools import wraps
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps, partial
+from io import BytesIO
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
 from random import choice
-from typing import List, Callable, Optional
+from typing import List, Callable, Optional, Tuple, Dict
 
 from telegram import Update, TelegramError, Chat, ParseMode, Bot, BotCommandScopeAllPrivateChats, BotCommand, User, \
     InlineKeyboardButton, InlineKeyboardMarkup, ChatPermissions, BotCommandScopeAllChatAdministrators
-from telegram.error import BadRequest
+from telegram.error import BadRequest, RetryAfter, TimedOut
 from telegram.ext import Updater, CallbackContext, Filters, MessageHandler, CallbackQueryHandler, MessageFilter, \
-    CommandHandler
-
-from emojis import Emojis, EmojiButton
-from images import CaptchaImage
+    CommandHandler, Dispatcher, JobQueue
+
+from emojis import Emojis, Emoji, EmojiButton, NONCE_LENGTH, NONCE_ALPHABET, decode_callback_data, is_select_callback, \
+    is_already_selected_callback
+from admission import AdmissionController, Modes
+from api import InstrumentedRequest, retry_deadline
+from backgrounds import BackgroundStore
+from catchup import Backlog, drain_backlog
+from encoder import Formats
+from guardrails import PendingCaptchas, OverflowPolicies, InFlight
+from images import CaptchaImage, RenderPool, RenderProfile, CaptchaSpec, BackgroundCache
+from lanes import LaneDispatcher, Lanes, Policies
+from layout import Layouts
+from metrics import metrics, PhaseTimer
 import utilities
 from mwt import MWT
+from sharding import Supervisor
 from config import config
 
-emojis = Emojis(max_codepoints=1)
-updater = Updater(
-    config.telegram.token,
-    workers=0,
-    persistence=None,  # disable persistence for now
+if __name__ in ("__main__", "__mp_main__"):
+    # run as a script (or imported again as one by the shard workers, see sharding.worker_main()): 'import main'
+    # must return this module instead of building all the module-level state a second time
+    sys.modules.setdefault("main", sys.modules[__name__])
+
+COMMANDS_HASH_FILE = "persistence/commands.json"
+EMOJIS_BBOXES_FILE = "persistence/emojis_bboxes.json"
+
+emojis: Optional[Emojis] = None  # loaded on first use (or warmed up in the background), see get_emojis()
+emojis_lock = threading.Lock()
+load_shedding_config = config.get("load_shedding", None) or {}
+admission = AdmissionController.from_config(load_shedding_config)
+render_pool = RenderPool()
+background_store: Optional[BackgroundStore] = None  # loaded on first use, see get_background_store()
+background_store_lock = threading.Lock()
+background_cache = BackgroundCache(max_bytes=config.captcha.get("backgrounds_cache_mb", 64) * 1024 * 1024)
+pending_captchas = PendingCaptchas(
+    max_per_chat=config.captcha.get("max_pending_per_chat", 200),
+    max_total=config.captcha.get("max_pending_total", 5000),
+    overflow_policy=config.captcha.get("overflow_policy", OverflowPolicies.EVICT_OLDEST)
 )
+joins_in_flight = InFlight()  # (chat_id, user_id) of the joins being processed
+updater: Optional[Updater] = None  # see build_updater()
+
+
+def get_emojis() -> Emojis:
+    global emojis
+
+    if emojis is None:
+        with emojis_lock:
+            if emojis is None:
+                emojis = Emojis(max_codepoints=1, bboxes_file=EMOJIS_BBOXES_FILE)
+
+    return emojis
+
+
+def get_background_store() -> BackgroundStore:
+    global background_store
+
+    if background_store is None:
+        with background_store_lock:
+            if background_store is None:
+                background_store = BackgroundStore(
+                    max_bytes=config.captcha.get("backgrounds_max_mb", 500) * 1024 * 1024,
+                    max_idle_days=config.captcha.get("backgrounds_max_idle_days", 180)
+                )
+
+    return background_store
+
+
+def build_updater() -> Updater:
+    global updater
+
+    if updater is None:
+        bot = Bot(
+            config.telegram.token,
+            base_url=config.telegram.get("base_url", None),  # point it to a local/fake Bot API server to test the bot
+            request=InstrumentedRequest(
+                # one connection for each thread that can call the api: polling, job queue, lanes and executors
+                con_pool_size=4 + len(Lanes.ALL) + utilities.API_EXECUTOR_WORKERS + config.captcha.get("expiry_concurrency", 16) +
+                              CATCH_UP_RENDER_WORKERS,
+                connect_timeout=5.0,
+                read_timeout=10.0,
+                max_retries=config.telegram.get("api_max_retries", 3),
+                max_retry_after=config.telegram.get("api_max_retry_after", 30)
+            )
+        )
+        job_queue = JobQueue()
+        dispatcher = LaneDispatcher(
+            bot,
+            queue.Queue(),
+            workers=0,
+            job_queue=job_queue,
+            persistence=None,  # disable persistence for now
+            lanes_policy=config.telegram.get("lanes_policy", Policies.STRICT),
+            fast_weight=config.telegram.get("lanes_fast_weight", 4),
+            chat_quantum=config.telegram.get("lanes_chat_quantum", 1)
+        )
+        job_queue.set_dispatcher(dispatcher)
+
+        updater = Updater(dispatcher=dispatcher, workers=None)  # the workers are the dispatcher's lanes
+
+    return updater
 
 
 class StandardPermission:
@@ -49,18 +147,61 @@ class NewGroup(MessageFilter):
         if message.new_chat_members:
             member: User
             for member in message.new_chat_members:
-                if member.id == updater.bot.id:
+                if member.id == message.bot.id:
                     return True
 
 
-def load_logging_config(file_name='logging.json'):
+log_listener: Optional[QueueListener] = None
+
+
+def setup_logging_queue(log_queue: Optional[multiprocessing.Queue] = None):
+    # the root logger's handlers are moved to a background thread: logging calls only enqueue the record,
+    # so handlers never wait for the disk or the console. In the shard workers, the records are sent to the
+    # supervisor's log_queue instead, and the handlers are not used
+    global log_listener
+
+    root_logger = logging.getLogger()
+    handlers = root_logger.handlers[:]
+    if not handlers:
+        return
+
+    for handler in handlers:
+        root_logger.removeHandler(handler)
+
+    if log_queue is not None:
+        for handler in handlers:
+            handler.close()
+        root_logger.addHandler(QueueHandler(log_queue))
+        return
+
+    log_queue = queue.SimpleQueue()
+    root_logger.addHandler(QueueHandler(log_queue))
+
+    log_listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    log_listener.start()
+
+
+def stop_logging_queue():
+    global log_listener
+
+    if log_listener:
+        log_listener.stop()  # flushes the records still in the queue
+        log_listener = None
+
+
+def load_logging_config(file_name='logging.json', use_queue=True, log_queue: Optional[multiprocessing.Queue] = None):
     with open(file_name, 'r') as f:
         logging_config = json.load(f)
 
+    stop_logging_queue()
     logging.config.dictConfig(logging_config)
 
+    if use_queue or log_queue is not None:
+        setup_logging_queue(log_queue)
+
+
+atexit.register(stop_logging_queue)
 
-load_logging_config("logging.json")
 
 logger = logging.getLogger(__name__)
 
@@ -130,8 +271,8 @@ def get_captcha():
         @wraps(func)
         def wrapped(update: Update, context: CallbackContext, *args, **kwargs):
             # logger.debug("%s", update.callback_query.data)
-            target_user_id = int(context.match[2])
-            if target_user_id != update.effective_user.id:
+            button = decode_callback_data(update.callback_query.data)
+            if button.user_id != update.effective_user.id:
                 update.callback_query.answer("Questo test è destinato ad un altro utente", show_alert=True, cache_time=60*60*24)
                 return
 
@@ -139,12 +280,17 @@ def get_captcha():
                 update.callback_query.answer("Questo test non è più valido")
                 utilities.safe_delete(update.callback_query.message)
 
-                context.chat_data.pop(update.effective_user.id, None)
+                pop_captcha(context.chat_data, update.effective_chat.id, update.effective_user.id)
                 return
 
             captcha = context.chat_data[update.effective_user.id]["captcha"]
+            if button.nonce != captcha.nonce:
+                # a button of an older captcha sent to the same user
+                update.callback_query.answer("Questo test non è più valido")
+                utilities.safe_delete(update.callback_query.message)
+                return
 
-            result_captcha = func(update, context, captcha, *args, **kwargs)
+            result_captcha = func(update, context, captcha, button.index, *args, **kwargs)
             if result_captcha:
                 result_captcha.updated_on = utilities.now_utc()
                 context.chat_data[update.effective_user.id]["captcha"] = result_captcha
@@ -174,7 +320,9 @@ class EmojiCaptcha:
             correct_emojis_number: int,  # number of emojis in the image (that are marked as correct in the keyboard)
             correct_emojis_threshold: Optional[int] = None,  # minimum number of correct emojis to select to pass the captcha
             number_of_buttons: int = 8,  # number of keyboard buttons
-            allowed_errors: int = 2  # number of errors the user is allowed to do
+            allowed_errors: int = 2,  # number of errors the user is allowed to do
+            correct_emojis: Optional[List[Emoji]] = None,  # use these emojis as the correct ones (eg. when reusing an image)
+            seed: Optional[int] = None  # the same seed generates the same emojis (and image, see image_spec())
     ):
         if number_of_buttons < self.MIN_BUTTONS:
             raise ValueError(f"the captcha must have at least {self.MIN_BUTTONS} buttons")
@@ -191,15 +339,24 @@ class EmojiCaptcha:
         if correct_emojis_threshold and correct_emojis_threshold > correct_emojis_number:
             raise ValueError(f"the number of correct emojis to pass the test ({correct_emojis_threshold}) cannot be greater than the number of emojis on the image ({correct_emojis_number})")
 
-        self.user = user
+        self.user = utilities.slim_user(user)  # the full object (and its bot) is not needed
         self.chat_id = chat.id
         self.message_id = None  # captcha message_id
+        self.file_id = None  # file_id of the sent image, to send it again without rendering it
         self.correct_emojis_number = correct_emojis_number
         self.correct_emojis_threshold = correct_emojis_threshold or self.correct_emojis_number
         self.number_of_buttons = number_of_buttons
         self.errors = 0
         self.allowed_errors = allowed_errors
         self.service_message_id = service_message_id
+        self.seed = seed if seed is not None else random.getrandbits(32)
+        # the generator is not stored: the seed is enough to generate the same captcha again
+        rng = random.Random(self.seed)
+        self.nonce = "".join(rng.choice(NONCE_ALPHABET) for _ in range(NONCE_LENGTH))  # tells captchas apart in the callback data
+
+        self.reply_markup: Optional[InlineKeyboardMarkup] = None  # built once, then only the selected buttons are replaced
+        self.reply_markup_changed = False  # whether the keyboard changed since it was last sent
+        self.buttons_position: List[Tuple[int, int]] = []  # (row, column) of every button in the keyboard
 
         now = utilities.now_utc()
         self.created_on = now
@@ -207,10 +364,18 @@ class EmojiCaptcha:
 
         self.emojis: List[EmojiButton] = []
 
-        self.gen_emojis()
+        self.gen_emojis(correct_emojis, rng=rng)
+
+    def gen_emojis(self, correct_emojis: Optional[List[Emoji]] = None, rng: Optional[random.Random] = None):
+        if rng is None:
+            rng = random.Random(self.seed)
 
-    def gen_emojis(self):
-        random_emojis = emojis.random(count=self.number_of_buttons)
+        if correct_emojis:
+            correct_ids = [e.id for e in correct_emojis]
+            other_emojis = [e for e in get_emojis().random(count=self.number_of_buttons + len(correct_ids), rng=rng) if e.id not in correct_ids]
+            random_emojis = list(correct_emojis) + other_emojis[:self.number_of_buttons - len(correct_ids)]
+        else:
+            random_emojis = get_emojis().random(count=self.number_of_buttons, rng=rng)
 
         self.emojis = [EmojiButton.convert(e) for e in random_emojis]
 
@@ -218,31 +383,44 @@ class EmojiCaptcha:
             # mark the first emojis as correct, we will shuffle the list later
             self.emojis[i].correct = True
 
-        random.shuffle(self.emojis)
+        rng.shuffle(self.emojis)
+        self.reply_markup = None
+
+    def image_spec(self, background: str, profile: RenderProfile) -> CaptchaSpec:
+        return CaptchaSpec(self.seed, tuple(e.id for e in self.get_correct_emojis()), background, profile)
 
     def get_reply_markup(self, rows=2):
         if not self.emojis:
             self.gen_emojis()
 
+        if self.reply_markup:
+            return self.reply_markup
+
         if self.number_of_buttons <= self.MAX_SINGLE_ROW_EMOJIS:
             rows = 1
 
         keyboard = []
+        self.buttons_position = []
         # max two lines of emojis
         buttons_per_row = self.number_of_buttons if self.number_of_buttons <= self.MAX_SINGLE_ROW_EMOJIS else int(self.number_of_buttons / rows)
         i = 0
         for row_number in range(rows):
             buttons_row = []
             for column_number in range(buttons_per_row):
-                emoji = self.emojis[i]
-                button = InlineKeyboardButton(emoji.unicode, callback_data=emoji.user_callback_data(self.user.id))
-
-                buttons_row.append(button)
+                buttons_row.append(self.get_button(i))
+                self.buttons_position.append((row_number, column_number))
                 i += 1
 
             keyboard.append(buttons_row)
 
-        return InlineKeyboardMarkup(keyboard)
+        self.reply_markup = InlineKeyboardMarkup(keyboard)
+        self.reply_markup_changed = False
+
+        return self.reply_markup
+
+    def get_button(self, index):
+        emoji = self.emojis[index]
+        return InlineKeyboardButton(emoji.unicode, callback_data=emoji.user_callback_data(self.user.id, index, self.nonce))
 
     def add_error(self, errors_to_add=1):
         self.errors += errors_to_add
@@ -263,20 +441,26 @@ class EmojiCaptcha:
     def correct_answers_count(self):
         return sum(e.already_selected and e.correct for e in self.emojis)
 
-    def get_emoji(self, emoji_id):
-        for emoji in self.emojis:
-            if emoji.id == emoji_id:
-                return emoji
+    def get_emoji(self, index):
+        if not 0 <= index < len(self.emojis):
+            raise ValueError(f"emoji index out of range: {index}")
 
-        raise ValueError(f"emoji_id (hex codepoints) not found: {emoji_id}")
+        return self.emojis[index]
 
-    def mark_as_selected(self, emoji_id):
-        for i, emoji in enumerate(self.emojis):
-            if emoji.id == emoji_id:
-                self.emojis[i].already_selected = True
-                return
+    def mark_as_selected(self, index):
+        emoji = self.get_emoji(index)
+        if emoji.already_selected:
+            return False
+
+        emoji.already_selected = True
+
+        if self.reply_markup:
+            # patch only the selected button
+            row, column = self.buttons_position[index]
+            self.reply_markup.inline_keyboard[row][column] = self.get_button(index)
+            self.reply_markup_changed = True
 
-        raise ValueError(f"emoji_id (hex codepoints) not found: {emoji_id}")
+        return True
 
     def __str__(self):
         emojis_list = [f"{type(e).__name__}(id={e.id})" for e in self.emojis]
@@ -309,19 +493,8 @@ def on_unrestrict_command(update: Update, context: CallbackContext):
         update.message.reply_html("Unrestricted")
 
 
-def get_chat_background_path(chat_id: int) -> Path:
-    chat_id_str = str(chat_id).replace("-100", "")
-    file_name = f"background_{chat_id_str}.jpg"
-
-    return Path("backgrounds") / file_name
-
-
 def get_background_path(chat_id: int, default_file_path: str) -> Path:
-    image_path = get_chat_background_path(chat_id)
-    if not image_path.exists():
-        return Path(default_file_path)
-
-    return image_path
+    return get_background_store().path_for(chat_id) or Path(default_file_path)
 
 
 @fail_with_message()
@@ -332,9 +505,14 @@ def on_setphoto_command(update: Update, context: CallbackContext):
     if not update.message.reply_to_message or not update.message.reply_to_message.photo:
         return update.message.reply_html("Rispondi ad una foto con <code>/setphoto</code> per utilizzarla come sfondo")
 
-    file_path = get_chat_background_path(update.effective_chat.id)
-    photo_file = update.message.reply_to_message.photo[-1].get_file()
-    photo_file.download(file_path)
+    photo = update.message.reply_to_message.photo[-1]
+    store = get_background_store()
+    digest = store.find(photo.file_unique_id)
+    if not digest:
+        # not used by any chat yet
+        digest = store.add(bytes(photo.get_file().download_as_bytearray()), file_unique_id=photo.file_unique_id)
+    store.assign(update.effective_chat.id, digest)
+    store.save()
 
     text = f"Questa foto verrà utilizzata come sfondo per il captcha"
     if config.captcha.image_max_side:
@@ -343,6 +521,221 @@ def on_setphoto_command(update: Update, context: CallbackContext):
     update.message.reply_to_message.reply_html(text)
 
 
+def store_captcha(chat_data: dict, chat_id: int, user_id: int, captcha: EmojiCaptcha):
+    if "captcha" not in chat_data.get(user_id, {}):
+        pending_captchas.added(chat_id)
+
+    chat_data[user_id] = {"captcha": captcha}
+
+
+def pop_captcha(chat_data: dict, chat_id: int, user_id: int) -> Optional[EmojiCaptcha]:
+    user_data = chat_data.pop(user_id, None)
+    if not user_data or "captcha" not in user_data:
+        return None
+
+    pending_captchas.removed(chat_id)
+    return user_data["captcha"]
+
+
+def evict_oldest_captcha(bot: Bot, chat_data: dict, chat_id: int) -> bool:
+    # False if there was nothing to evict (eg. the chat's slots are all taken by deferred captchas)
+    pending = [(user_data["captcha"].created_on, user_id) for user_id, user_data in list(chat_data.items()) if "captcha" in user_data]
+    if not pending:
+        return False
+
+    _, user_id = min(pending)
+    captcha = pop_captcha(chat_data, chat_id, user_id)
+    if not captcha:
+        return False
+
+    logger.info("evicted the captcha of user %d from chat %d, the user stays muted", user_id, chat_id)
+    utilities.run_concurrently(partial(utilities.safe_delete_by_id, bot, chat_id, captcha.message_id))
+    return True
+
+
+def captcha_settings(mode: int = Modes.FULL):
+    # image_max_side, image_emojis and correct emojis threshold to use for a load shedding mode
+    max_side = config.captcha.image_max_side
+    emojis_number = config.captcha.image_emojis
+    if mode >= Modes.REDUCED and load_shedding_config.get("reduced_max_side", 320):
+        reduced_max_side = load_shedding_config.get("reduced_max_side", 320)
+        max_side = min(max_side, reduced_max_side) if max_side else reduced_max_side
+    if mode >= Modes.MINIMAL:
+        emojis_number = min(emojis_number, load_shedding_config.get("minimal_emojis", 2))
+
+    threshold = min(config.captcha.image_emojis_correct_threshold or emojis_number, emojis_number)
+
+    return max_side, emojis_number, threshold
+
+
+def captcha_caption(captcha: EmojiCaptcha) -> str:
+    caption_emojis_to_select = captcha.correct_emojis_threshold if captcha.correct_emojis_threshold > 1 else "una"
+    return f"Ciao {utilities.mention_escaped(captcha.user)}, benvenuto/a!" \
+           f"\nPer poter parlare in questa chat, <b>devi dimostrare di non essere un bot!</b> " \
+           f"Seleziona {caption_emojis_to_select} delle emoji che vedi nell'immagine utilizzando i " \
+           f"tasti qui sotto." \
+           f"\nTi sono concessi {captcha.remaining_attempts()} errori e {config.captcha.timeout} minuti di tempo"
+
+
+def resend_captcha(bot: Bot, chat: Chat, captcha: EmojiCaptcha, service_message_id: int) -> EmojiCaptcha:
+    # the user joined again while their captcha is pending: send the same image (by file_id, no render and no upload)
+    # with the same keyboard, and delete the previous message. Errors and timeout carry over
+    stale_message_ids = [captcha.message_id]
+    if config.captcha.delete_service_message and captcha.service_message_id != service_message_id:
+        stale_message_ids.append(captcha.service_message_id)
+    cleanup = utilities.run_concurrently(
+        *[partial(utilities.safe_delete_by_id, bot, chat.id, message_id, log_error=False) for message_id in stale_message_ids]
+    )
+
+    sent_message = bot.send_photo(
+        chat.id,
+        captcha.file_id,
+        caption=captcha_caption(captcha),
+        reply_markup=captcha.get_reply_markup(),
+        parse_mode=ParseMode.HTML
+    )
+
+    captcha.message_id = sent_message.message_id
+    captcha.service_message_id = service_message_id
+    captcha.reply_markup_changed = False
+    metrics.incr("captcha.reused")
+
+    utilities.wait_all(cleanup)
+    return captcha
+
+
+def send_captcha(bot: Bot, chat: Chat, user: User, service_message_id: int, chat_data: dict, mode: int = Modes.FULL):
+    pending_captcha: Optional[EmojiCaptcha] = chat_data.get(user.id, {}).get("captcha")
+    if pending_captcha and pending_captcha.file_id:
+        try:
+            return resend_captcha(bot, chat, pending_captcha, service_message_id)
+        except (TelegramError, BadRequest) as e:
+            logger.warning("couldn't send the pending captcha of user %d in chat %d again, rendering a new one: %s",
+                           user.id, chat.id, str(e))
+
+    max_side, emojis_number, threshold = captcha_settings(mode)
+    background_path = get_background_path(chat.id, config.captcha.image_path)
+    pool_key = (str(background_path), max_side, emojis_number)
+
+    pooled_render = render_pool.get(pool_key) if mode >= Modes.POOLED else None
+
+    captcha = EmojiCaptcha(
+        user,
+        chat,
+        service_message_id=service_message_id,
+        correct_emojis_number=emojis_number,
+        correct_emojis_threshold=threshold,
+        number_of_buttons=config.captcha.image_buttons,
+        allowed_errors=config.captcha.allowed_errors,
+        correct_emojis=pooled_render.emojis_list if pooled_render else None
+    )
+
+    if pooled_render:
+        image_bytes = pooled_render.image_bytes
+    else:
+        profile = RenderProfile(
+            max_side=max_side,
+            scale_factor=config.captcha.image_scale_factor,
+            layout=config.captcha.get("image_layout", Layouts.GRID),
+            image_format=config.captcha.get("image_format", Formats.PNG),
+            max_bytes=config.captcha.get("image_max_bytes", 0)
+        )
+        captcha_image = CaptchaImage.from_spec(captcha.image_spec(str(background_path), profile), catalog=get_emojis(),
+                                                backgrounds=background_cache)
+        image = BytesIO()
+        with metrics.timer("captcha.render"):
+            captcha_image.generate_capctha_image(image, image_format=profile.image_format, max_bytes=profile.max_bytes)
+        image_bytes = image.getvalue()
+
+        encoded = captcha_image.encoded
+        metrics.observe(f"captcha.encode.{encoded.format}", encoded.seconds)
+        metrics.incr("captcha.encoded_bytes", encoded.size)
+        metrics.set_gauge("captcha.last_encoded_bytes", encoded.size)
+        logger.debug("captcha for %d in %d: %d bytes (%s), encoded in %.1f ms",
+                     user.id, chat.id, encoded.size, encoded.format, encoded.seconds * 1000)
+
+        if mode != Modes.FULL:
+            # keep the cheap renders around, so they can be reused if the load keeps growing
+            render_pool.add(pool_key, captcha.get_correct_emojis(), image_bytes)
+
+    sent_message = bot.send_photo(
+        chat.id,
+        image_bytes,
+        caption=captcha_caption(captcha),
+        reply_markup=captcha.get_reply_markup(),
+        parse_mode=ParseMode.HTML
+    )
+
+    captcha.message_id = sent_message.message_id
+    captcha.file_id = sent_message.photo[-1].file_id
+
+    if pending_captcha:
+        # the previous captcha couldn't be sent again: its message is stale now
+        utilities.run_concurrently(partial(utilities.safe_delete_by_id, bot, chat.id, pending_captcha.message_id, log_error=False))
+
+    store_captcha(chat_data, chat.id, user.id, captcha)
+
+    return captcha
+
+
+def refresh_emojis(context: CallbackContext):
+    if emojis is None:
+        # not loaded yet: it will be up to date when loaded
+        return
+
+    diff = emojis.refresh()
+    emojis.save_bboxes()
+    if not diff:
+        return
+
+    logger.info("emojis catalog updated: %d added, %d removed, %d modified", len(diff.added), len(diff.removed), len(diff.modified))
+
+    discarded = render_pool.discard_emojis(diff.removed + diff.modified)
+    if discarded:
+        logger.debug("discarded %d pooled renders", discarded)
+
+
+def save_backgrounds(context: CallbackContext):
+    if background_store is None:
+        # not loaded yet: nothing to save
+        return
+
+    background_store.evict()
+    background_store.save()
+    metrics.set_gauge("backgrounds.disk_bytes", background_store.disk_usage())
+    metrics.set_gauge("backgrounds.cache_bytes", background_cache.size)
+
+
+def send_deferred_captcha(context: CallbackContext):
+    job_context = context.job.context
+    chat: Chat = job_context["chat"]
+    user: User = job_context["user"]
+
+    join_key = (chat.id, user.id)
+    if not joins_in_flight.claim(join_key):
+        # the user joined again and that join is being processed right now: it will send the captcha
+        logger.debug("deferred captcha of %d in %d: join already being processed", user.id, chat.id)
+        metrics.incr("joins.duplicated")
+        pending_captchas.removed(chat.id)
+        return
+
+    try:
+        send_captcha(
+            context.bot,
+            chat,
+            user,
+            job_context["service_message_id"],
+            context.dispatcher.chat_data[chat.id],
+            mode=Modes.POOLED
+        )
+    except (TelegramError, BadRequest) as e:
+        logger.error("error while sending deferred captcha in chat %d: %s", chat.id, str(e))
+    finally:
+        # the slot reserved by on_new_member(): the captcha (if sent) has been stored in the meantime
+        pending_captchas.removed(chat.id)
+        joins_in_flight.release(join_key)
+
+
 @fail_with_message()
 def on_new_member(update: Update, context: CallbackContext):
     logger.debug("new member in %d: %d", update.effective_chat.id, update.effective_user.id)
@@ -350,74 +743,111 @@ def on_new_member(update: Update, context: CallbackContext):
         # allow people to add other people without captchas
         return
 
-    if update.effective_user.id not in get_admin_ids(context.bot, update.effective_chat.id):
-        # testing: do not restrict if the user is an admin
-        update.effective_chat.restrict_member(update.effective_user.id, permissions=StandardPermission.MUTED)
-        if config.captcha.log_chat:
-            context.bot.send_message(
-                config.captcha.log_chat,
-                f"{utilities.mention_escaped(update.effective_user)} si è unito [#u{update.effective_user.id}]",
-                parse_mode=ParseMode.HTML
-            )
+    queue_depth = context.dispatcher.update_queue.qsize()
+    if isinstance(context.dispatcher, LaneDispatcher):
+        queue_depth += context.dispatcher.scheduler.depth(Lanes.BULK)
+    mode = admission.join(update.effective_chat.id, queue_depth=queue_depth)
 
-    captcha = EmojiCaptcha(
-        update.effective_user,
-        update.effective_chat,
-        service_message_id=update.message.message_id,
-        correct_emojis_number=config.captcha.image_emojis,
-        correct_emojis_threshold=config.captcha.image_emojis_correct_threshold,
-        number_of_buttons=config.captcha.image_buttons,
-        allowed_errors=config.captcha.allowed_errors
-    )
+    join_key = (update.effective_chat.id, update.effective_user.id)
+    if not joins_in_flight.claim(join_key):
+        # eg. a join and /testc racing: the first one sends the captcha
+        logger.debug("join of %d in %d already being processed", update.effective_user.id, update.effective_chat.id)
+        metrics.incr("joins.duplicated")
+        return
 
-    captcha_image = CaptchaImage(
-        background_path=get_background_path(update.effective_chat.id, config.captcha.image_path),
-        emojis_list=captcha.get_correct_emojis(),
-        max_side=config.captcha.image_max_side,
-        scale_factor=config.captcha.image_scale_factor
-    )
-    file_path = f"tmp/{update.effective_chat.id}_{update.message.message_id}.png"
-    captcha_image.generate_capctha_image(file_path)
+    admission.begin(update.effective_chat.id)
+    try:
+        # rejoins with a pending captcha get the same captcha again (see send_captcha())
+        rejoin = "captcha" in context.chat_data.get(update.effective_user.id, {})
+
+        side_effects = []  # api calls that don't depend on the captcha message, run while the image is generated
+        is_admin = update.effective_user.id in get_admin_ids(context.bot, update.effective_chat.id)
+        if not is_admin:
+            # testing: do not restrict if the user is an admin
+            side_effects.append(partial(
+                update.effective_chat.restrict_member,
+                update.effective_user.id,
+                permissions=StandardPermission.MUTED
+            ))
+            if config.captcha.log_chat and not rejoin:
+                side_effects.append(partial(
+                    context.bot.send_message,
+                    config.captcha.log_chat,
+                    f"{utilities.mention_escaped(update.effective_user)} si è unito [#u{update.effective_user.id}]",
+                    parse_mode=ParseMode.HTML
+                ))
+
+        overflow = pending_captchas.overflow(update.effective_chat.id) if not rejoin else None
+        if overflow == OverflowPolicies.BAN and not is_admin:
+            side_effects.append(partial(context.bot.ban_chat_member, update.effective_chat.id, update.effective_user.id))
+
+        side_effects_futures = utilities.run_concurrently(*side_effects)
+
+        if overflow == OverflowPolicies.EVICT_OLDEST and not evict_oldest_captcha(context.bot, context.chat_data, update.effective_chat.id):
+            overflow = OverflowPolicies.MUTE
+
+        if overflow in (OverflowPolicies.BAN, OverflowPolicies.MUTE):
+            # no captcha: the user has been banned or stays muted
+            logger.info("no captcha for user %d in chat %d: %s", update.effective_user.id, update.effective_chat.id, overflow)
+        elif mode == Modes.DEFERRED and not rejoin:
+            # mute the user right away, the captcha will be sent when things calm down.
+            # Deferred captchas count as pending, so the limits apply to them too
+            pending_captchas.added(update.effective_chat.id)
+            context.job_queue.run_once(
+                send_deferred_captcha,
+                load_shedding_config.get("deferred_delay", 30),
+                context={
+                    "chat": Chat(update.effective_chat.id, update.effective_chat.type),
+                    "user": utilities.slim_user(update.effective_user),
+                    "service_message_id": update.message.message_id
+                }
+            )
+        else:
+            send_captcha(
+                context.bot,
+                update.effective_chat,
+                update.effective_user,
+                update.message.message_id,
+                context.chat_data,
+                mode=mode
+            )
 
-    caption_emojis_to_select = captcha.correct_emojis_threshold if captcha.correct_emojis_threshold > 1 else "una"
-    caption = f"Ciao {utilities.mention_escaped(update.effective_user)}, benvenuto/a!" \
-              f"\nPer poter parlare in questa chat, <b>devi dimostrare di non essere un bot!</b> " \
-              f"Seleziona {caption_emojis_to_select} delle emoji che vedi nell'immagine utilizzando i " \
-              f"tasti qui sotto." \
-              f"\nTi sono concessi {captcha.remaining_attempts()} errori e {config.captcha.timeout} minuti di tempo"
-
-    with open(file_path, "rb") as f:
-        sent_message = update.message.reply_photo(
-            f,
-            caption=caption,
-            reply_markup=captcha.get_reply_markup(),
-            parse_mode=ParseMode.HTML,
-            quote=False
-        )
+        # raise errors from the side effects only after the captcha has been stored
+        utilities.wait_all(side_effects_futures)
+    finally:
+        admission.end(update.effective_chat.id)
+        joins_in_flight.release(join_key)
 
-    captcha_image.delete_generated_image()
 
-    captcha.message_id = sent_message.message_id
+@fail_with_message()
+@superadmin
+def on_metrics_command(update: Update, context: CallbackContext):
+    logger.debug("/metrics from %d", update.effective_user.id)
 
-    context.chat_data[update.effective_user.id] = {"captcha": captcha}
+    text = f"{admission.describe()}\n\n{metrics.format()}\npooled renders: {len(render_pool)}\n" \
+           f"pending captchas: {pending_captchas.total} in {len(pending_captchas.per_chat)} chats"
+    if isinstance(context.dispatcher, LaneDispatcher):
+        for chat_id, depth, oldest_wait in context.dispatcher.scheduler.busiest_chats(Lanes.BULK):
+            text += f"\nbulk lane, chat {chat_id}: {depth} waiting (oldest: {oldest_wait:.1f} s)"
+    update.message.reply_html(f"<code>{utilities.html_escape(text)}</code>")
 
 
 @fail_with_message(answer_to_message=False)
 @get_captcha()
-def on_already_selected_button(update: Update, context: CallbackContext, captcha: EmojiCaptcha):
+def on_already_selected_button(update: Update, context: CallbackContext, captcha: EmojiCaptcha, _index: int):
     update.callback_query.answer("Hai già selezionato questa emoji in precedenza", cache_time=60*60*24)
 
 
 @fail_with_message(answer_to_message=False)
 @get_captcha()
-def on_button(update: Update, context: CallbackContext, captcha: EmojiCaptcha):
-    emoji_id = context.match[1]
-    logger.info("user selected emoji: %s", emoji_id)
-
-    emoji = captcha.get_emoji(emoji_id)
-    logger.debug("emoji: %s (correct: %s)", emoji.codepoints_hex, emoji.correct)
+def on_button(update: Update, context: CallbackContext, captcha: EmojiCaptcha, index: int):
+    emoji = captcha.get_emoji(index)
+    logger.debug("user selected emoji: %s (correct: %s)", emoji.id, emoji.correct)
 
-    captcha.mark_as_selected(emoji.id)
+    if not captcha.mark_as_selected(index):
+        # the user clicked a stale keyboard
+        update.callback_query.answer("Hai già selezionato questa emoji in precedenza")
+        return
 
     new_caption = ""
     if emoji.correct:
@@ -430,39 +860,47 @@ def on_button(update: Update, context: CallbackContext, captcha: EmojiCaptcha):
             update.callback_query.answer(alert_text)
         else:
             logger.debug("captcha completed, cleaning up and lifting restrictions...")
-            context.chat_data.pop(update.effective_user.id, None)
+            pop_captcha(context.chat_data, update.effective_chat.id, update.effective_user.id)
 
-            utilities.safe_delete(update.callback_query.message)
+            cleanup = [partial(utilities.safe_delete, update.callback_query.message)]
             if config.captcha.delete_service_message:
-                utilities.safe_delete_by_id(context.bot, update.effective_chat.id, captcha.service_message_id)
+                cleanup.append(partial(utilities.safe_delete_by_id, context.bot, update.effective_chat.id, captcha.service_message_id))
 
-            run_and_log(
+            # not bound by the lane's retry deadline: a flood limit must not leave the user muted.
+            # Maybe the user has already been unrestricted
+            utilities.run_detached(partial(
+                run_and_log,
                 context.bot.restrict_chat_member,
                 update.effective_chat.id,
                 update.effective_user.id,
                 permissions=StandardPermission.UNLOCK_ALL
-            )  # maybe the user has already been unrestricted
+            ))
+
+            utilities.wait_all(utilities.run_concurrently(*cleanup))
             return
     else:
         errors = captcha.add_error()
         if errors > captcha.allowed_errors:
             logger.debug("captcha failed, cleaning up...")
-            context.chat_data.pop(update.effective_user.id, None)
+            pop_captcha(context.chat_data, update.effective_chat.id, update.effective_user.id)
 
-            utilities.safe_delete(update.callback_query.message)
+            cleanup = [partial(utilities.safe_delete, update.callback_query.message)]
             if config.captcha.delete_service_message:
-                utilities.safe_delete_by_id(context.bot, update.effective_chat.id, captcha.service_message_id)
+                cleanup.append(partial(utilities.safe_delete_by_id, context.bot, update.effective_chat.id, captcha.service_message_id))
 
             if config.captcha.send_message_on_fail:
                 target_chat_id = config.captcha.log_chat or update.effective_chat.id
                 user_mention = utilities.mention_escaped(update.effective_user)
-                context.bot.send_message(
+                utilities.run_detached(partial(
+                    run_and_log,
+                    context.bot.send_message,
                     target_chat_id,
                     f"{user_mention} non è riuscito/a a verificarsi a causa dei troppi errori ({errors}), "
                     f"è ancora membro di questo gruppo ma non portà parlare [#mute #u{update.effective_user.id}]",
                     parse_mode=ParseMode.HTML
-                )
+                ))
 
+            utilities.wait_all(utilities.run_concurrently(*cleanup))
             return
         elif captcha.remaining_attempts() == 0:
             update.callback_query.answer("\U000026a0\U0000fe0f Emoji errata! Non ti è più permesso fare errori!",
@@ -476,8 +914,9 @@ def on_button(update: Update, context: CallbackContext, captcha: EmojiCaptcha):
 
             update.callback_query.answer(alert_text)
 
-    reply_markup = captcha.get_reply_markup()
-    update.callback_query.edit_message_reply_markup(reply_markup=reply_markup)
+    if captcha.reply_markup_changed:
+        update.callback_query.edit_message_reply_markup(reply_markup=captcha.get_reply_markup())
+        captcha.reply_markup_changed = False
 
     return captcha
 
@@ -492,85 +931,294 @@ def on_new_group_chat(update: Update, _):
         return
 
 
+EXPIRY_DEADLINE = 50  # seconds: the sweep must end before the next one (every 60 seconds)
+DIGEST_MAX_LENGTH = 4096  # Telegram's limit for a message (counted on the html source, so there's some margin)
+CATCH_UP_RENDER_WORKERS = 2  # renders hold the gil: a second thread only overlaps them with the upload of the previous captcha
+
+
+def expire_captcha(bot: Bot, chat_id: int, captcha: EmojiCaptcha, deadline: float) -> Optional[bool]:
+    # returns whether the user has been banned, or None if the ban should be retried during the next sweep
+    message_ids = [captcha.message_id]
+    if config.captcha.delete_service_message:
+        message_ids.append(captcha.service_message_id)
+
+    # flood limits and timeouts are retried by the request layer, but not past the deadline
+    with retry_deadline(deadline):
+        for message_id in message_ids:
+            utilities.safe_delete_by_id(bot, chat_id, message_id, log_error=True)
+
+        try:
+            bot.ban_chat_member(chat_id, captcha.user.id, revoke_messages=True)
+            return True
+        except (RetryAfter, TimedOut) as e:
+            logger.warning("couldn't ban user %d from chat %d before the deadline: %s", captcha.user.id, chat_id, str(e))
+            return None
+        except (TelegramError, BadRequest) as e:
+            logger.error("error while banning user: %s", str(e))
+            return False
+
+
+def send_ban_digest(bot: Bot, target_chat_id: int, banned: List[Tuple[int, EmojiCaptcha]], deadline: float):
+    # as few messages as possible for all the users banned from the chats logged in target_chat_id
+    if not banned:
+        return
+
+    header = f"Questi utenti non hanno completato il test nei {config.captcha.timeout} minuti previsti e " \
+             f"sono stati bloccati:"
+    texts = [header]
+    for chat_id, captcha in banned:
+        line = f"• {utilities.mention_escaped(captcha.user)}, {captcha.get_correct_and_selected_count()} emoji " \
+               f"corrette su {captcha.correct_emojis_threshold} [#ban #u{captcha.user.id}]" \
+               + (f" [{chat_id}]" if config.captcha.log_chat else "")
+        if utilities.text_length(texts[-1]) + 1 + utilities.text_length(line) > DIGEST_MAX_LENGTH:
+            texts.append(header)
+        texts[-1] += "\n" + line
+
+    for text in texts:
+        try:
+            with retry_deadline(deadline):
+                bot.send_message(target_chat_id, text, parse_mode=ParseMode.HTML)
+        except (TelegramError, BadRequest) as e:
+            logger.error("error while sending the ban digest in %d: %s", target_chat_id, str(e))
+
+
 def cleanup_and_ban(context: CallbackContext):
-    for chat_id, chat_data in context.dispatcher.chat_data.items():
-        user_id_to_pop = []
-        for user_id, user_data in chat_data.items():
+    deadline = time.monotonic() + EXPIRY_DEADLINE
+    now = utilities.now_utc()
+
+    # collect (and pop) all the expired captchas first, then process them as a batch
+    expired: List[Tuple[int, EmojiCaptcha]] = []
+    for chat_id, chat_data in list(context.dispatcher.chat_data.items()):
+        for user_id, user_data in list(chat_data.items()):
             if "captcha" not in user_data:
                 continue
 
             captcha: EmojiCaptcha = user_data["captcha"]
 
-            now = utilities.now_utc()
             diff_seconds = (now - captcha.created_on).total_seconds()
             if diff_seconds <= config.captcha.timeout * 60:
                 continue
 
-            logger.info("cleaning up user %d data from chat %d: diff of %d seconds", user_id, chat_id, diff_seconds)
+            logger.debug("cleaning up user %d data from chat %d: diff of %d seconds", user_id, chat_id, diff_seconds)
+            pop_captcha(chat_data, chat_id, user_id)
+            expired.append((chat_id, captcha))
 
-            utilities.safe_delete_by_id(context.bot, chat_id, captcha.message_id, log_error=True)
-            if config.captcha.delete_service_message:
-                utilities.safe_delete_by_id(context.bot, chat_id, captcha.service_message_id)
+    if not expired:
+        return
 
-            ban_success = False
-            try:
-                context.bot.ban_chat_member(chat_id, captcha.user.id, revoke_messages=True)
-                ban_success = True
-            except (TelegramError, BadRequest) as e:
-                logger.error("error while banning user: %s", str(e))
-
-            if ban_success and config.captcha.send_message_on_fail:
-                target_chat_id = config.captcha.log_chat or chat_id
-                try:
-                    user_mention = utilities.mention_escaped(captcha.user)
-                    context.bot.send_message(
-                        target_chat_id,
-                        f"{user_mention} non ha completato il test nei {config.captcha.timeout} minuti previsti, "
-                        f"è stato/a bloccato/a, {captcha.get_correct_and_selected_count()} emoji corrette su "
-                        f"{captcha.correct_emojis_threshold} [#ban #u{captcha.user.id}]",
-                        parse_mode=ParseMode.HTML
-                    )
-                except (TelegramError, BadRequest) as e:
-                    logger.error("error while sending the message in the group: %s", str(e))
+    logger.info("%d expired captchas", len(expired))
+
+    with ThreadPoolExecutor(max_workers=config.captcha.get("expiry_concurrency", 16), thread_name_prefix="expiry") as executor:
+        results = list(executor.map(lambda item: expire_captcha(context.bot, item[0], item[1], deadline), expired))
+
+    digests: Dict[int, List[Tuple[int, EmojiCaptcha]]] = {}
+    retry = 0
+    for (chat_id, captcha), banned in zip(expired, results):
+        if banned is None:
+            # flood limited: put it back, the next sweep will try again
+            chat_data = context.dispatcher.chat_data[chat_id]
+            if captcha.user.id not in chat_data:
+                store_captcha(chat_data, chat_id, captcha.user.id, captcha)
+            retry += 1
+        elif banned and config.captcha.send_message_on_fail:
+            digests.setdefault(config.captcha.log_chat or chat_id, []).append((chat_id, captcha))
+
+    for target_chat_id, banned in digests.items():
+        send_ban_digest(context.bot, target_chat_id, banned, deadline)
+
+    metrics.incr("expiry.expired", len(expired))
+    metrics.incr("expiry.retried", retry)
+    logger.info("expired captchas processed: %d banned, %d to retry", sum(1 for r in results if r), retry)
+
+
+def catch_up_joins(bot: Bot, dispatcher: Dispatcher, backlog: Backlog):
+    # restrict and challenge the users who joined while the bot was offline: every user of every chat is muted
+    # first, then the captchas are rendered in their own executor, so the cpu-bound renders don't delay the
+    # restrictions queued behind them in the api executor
+    start = time.perf_counter()
+    chat_ids = list(backlog.joins)
+    admin_ids_futures = utilities.run_concurrently(*[partial(get_admin_ids, bot, chat_id) for chat_id in chat_ids])
+
+    futures = []  # (chat_id, future) of all the api calls and captchas
+    captchas = []  # (chat_id, send_captcha call)
+    new_members: Dict[int, List[User]] = {}
+    for chat_id, admin_ids_future in zip(chat_ids, admin_ids_futures):
+        joins = backlog.joins[chat_id]
+        try:
+            admin_ids = admin_ids_future.result()
+        except (TelegramError, BadRequest) as e:
+            # most likely the bot is not a member of the chat anymore
+            logger.error("catch up: skipping %d joins in chat %d: %s", len(joins), chat_id, str(e))
+            continue
+
+        chat_data = dispatcher.chat_data[chat_id]
+        for user_id, update in joins.items():
+            if user_id in admin_ids:
+                continue
 
-            user_id_to_pop.append(user_id)
+            chat, user = update.effective_chat, update.effective_user
+            futures.extend((chat_id, f) for f in utilities.run_concurrently(
+                partial(chat.restrict_member, user_id, permissions=StandardPermission.MUTED)
+            ))
+
+            overflow = pending_captchas.overflow(chat_id)
+            if overflow == OverflowPolicies.EVICT_OLDEST:
+                overflow = None if evict_oldest_captcha(bot, chat_data, chat_id) else OverflowPolicies.MUTE
+            if overflow:
+                logger.info("catch up: no captcha for user %d in chat %d: %s", user_id, chat_id, overflow)
+                if overflow == OverflowPolicies.BAN:
+                    futures.extend((chat_id, f) for f in utilities.run_concurrently(partial(bot.ban_chat_member, chat_id, user_id)))
+                continue
 
-        if user_id_to_pop:
-            logger.debug("popping %d users from %d", len(user_id_to_pop), chat_id)
-            for user_id in user_id_to_pop:
-                logger.debug("popping %d", user_id)
-                chat_data.pop(user_id, None)
+            # deferring doesn't make sense here: use at most the cheapest renders
+            mode = min(admission.join(chat_id), Modes.POOLED)
+            pending_captchas.added(chat_id)  # reserve the slot until the captcha is stored
+            captchas.append((chat_id, partial(send_captcha, bot, chat, user, update.message.message_id, chat_data, mode=mode)))
+            new_members.setdefault(chat_id, []).append(user)
 
+    with ThreadPoolExecutor(max_workers=CATCH_UP_RENDER_WORKERS, thread_name_prefix="catch-up") as executor:
+        for chat_id, send in captchas:
+            send_future = executor.submit(send)
+            send_future.add_done_callback(lambda _, c=chat_id: pending_captchas.removed(c))
+            futures.append((chat_id, send_future))
 
-def main():
-    dispatcher = updater.dispatcher
+        if config.captcha.log_chat:
+            for chat_id, users in new_members.items():
+                mentions = ", ".join(f"{utilities.mention_escaped(user)} [#u{user.id}]" for user in users)
+                futures.extend((chat_id, f) for f in utilities.run_concurrently(partial(
+                    bot.send_message,
+                    config.captcha.log_chat,
+                    f"Utenti che si sono uniti a {chat_id} mentre il bot era offline: {mentions}",
+                    parse_mode=ParseMode.HTML
+                )))
 
+        for chat_id, future in futures:
+            try:
+                future.result()
+            except (TelegramError, BadRequest) as e:
+                logger.error("catch up: error in chat %d: %s", chat_id, str(e))
+
+    metrics.observe("catchup.joins", time.perf_counter() - start)
+    logger.info("catch up: %d captchas sent in %.2f seconds", len(captchas), time.perf_counter() - start)
+
+
+def setup_dispatcher(dispatcher: Dispatcher):
     new_group_filter = NewGroup()
     dispatcher.add_handler(MessageHandler(new_group_filter, on_new_group_chat))
     dispatcher.add_handler(CommandHandler(["setphoto"], on_setphoto_command, filters=Filters.chat_type.supergroup))
     dispatcher.add_handler(CommandHandler(["testc"], on_forced_captcha_command, filters=Filters.chat_type.supergroup))
+    dispatcher.add_handler(CommandHandler(["metrics"], on_metrics_command))
     dispatcher.add_handler(MessageHandler(Filters.chat_type.supergroup & Filters.regex(r"^!(?:ur|unrestrict)"), on_unrestrict_command))
     dispatcher.add_handler(MessageHandler(Filters.status_update.new_chat_members & ~new_group_filter, on_new_member))
 
-    dispatcher.add_handler(CallbackQueryHandler(on_already_selected_button, pattern=r'^button:already_(solved|error):user(\d+)$'))
-    dispatcher.add_handler(CallbackQueryHandler(on_button, pattern=r'^button:(.*):user(\d+)$'))
+    dispatcher.add_handler(CallbackQueryHandler(on_already_selected_button, pattern=is_already_selected_callback))
+    dispatcher.add_handler(CallbackQueryHandler(on_button, pattern=is_select_callback))
 
-    updater.job_queue.run_repeating(cleanup_and_ban, interval=60, first=60)
+    dispatcher.job_queue.run_repeating(cleanup_and_ban, interval=60, first=60)
+    dispatcher.job_queue.run_repeating(save_backgrounds, interval=60 * 60, first=60)
 
-    updater.bot.set_my_commands([])  # make sure the bot doesn't have any command set...
-    updater.bot.set_my_commands(  # ...then set the scope for private chats
-        [],
-        scope=BotCommandScopeAllPrivateChats()
-    )
-    updater.bot.set_my_commands(  # ...then set the scope for group administrators
-        [BotCommand("setphoto", "imposta una foto come background del captcha")],
-        scope=BotCommandScopeAllChatAdministrators()
-    )
+    emojis_refresh_interval = config.captcha.get("emojis_refresh_interval", 60)
+    if emojis_refresh_interval:
+        dispatcher.job_queue.run_repeating(refresh_emojis, interval=emojis_refresh_interval, first=emojis_refresh_interval)
+
+
+COMMANDS = (
+    # make sure the bot doesn't have any command set...
+    (None, []),
+    # ...then set the scope for private chats
+    (BotCommandScopeAllPrivateChats(), []),
+    # ...then set the scope for group administrators
+    (BotCommandScopeAllChatAdministrators(), [BotCommand("setphoto", "imposta una foto come background del captcha")]),
+)
+
+
+def commands_hash(bot_id: str) -> str:
+    commands_list = [
+        (scope.type if scope else None, [(command.command, command.description) for command in commands])
+        for scope, commands in COMMANDS
+    ]
+
+    return hashlib.sha256(json.dumps([bot_id, commands_list]).encode()).hexdigest()
+
+
+def set_commands(bot: Bot, hash_file: str = COMMANDS_HASH_FILE):
+    # the commands are set only when they changed since the last run
+    bot_id = config.telegram.token.split(":")[0]
+    new_hash = commands_hash(bot_id)
+
+    try:
+        with open(hash_file, "r") as f:
+            saved_hashes = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        saved_hashes = {}
+
+    if saved_hashes.get(bot_id) == new_hash:
+        logger.debug("commands didn't change, skipping set_my_commands")
+        return False
+
+    for scope, commands in COMMANDS:
+        bot.set_my_commands(commands, scope=scope)
+
+    saved_hashes[bot_id] = new_hash
+    with open(hash_file, "w") as f:
+        json.dump(saved_hashes, f)
+
+    logger.info("commands updated")
+    return True
+
+
+def main():
+    startup = PhaseTimer("startup", registry=metrics)
+
+    with startup.phase("logging"):
+        load_logging_config("logging.json")
+
+    # the emojis catalog is not needed to start polling: load it in the background
+    threading.Thread(target=get_emojis, name="warm-up", daemon=True).start()
+
+    with startup.phase("updater"):
+        build_updater()
+
+    # commands are not needed to process joins either
+    utilities.run_concurrently(partial(run_and_log, set_commands, updater.bot))
 
     allowed_updates = ["message", "callback_query"]  # https://core.telegram.org/bots/api#getupdates
 
-    logger.info("running as @%s, allowed updates: %s", updater.bot.username, allowed_updates)
-    updater.start_polling(drop_pending_updates=True, allowed_updates=allowed_updates)
+    catch_up = config.telegram.get("catch_up", True)
+    catch_up_max_updates = config.telegram.get("catch_up_max_updates", 10000)
+
+    shards = config.telegram.get("shards", 0)
+    if shards > 1:
+        # each worker process owns the captchas of the chats routed to it
+        logger.info("running with %d shards, allowed updates: %s", shards, allowed_updates)
+        logger.info("startup took %s", startup.summary())
+        Supervisor(updater.bot, shards, allowed_updates=allowed_updates, catch_up=catch_up,
+                   catch_up_max_updates=catch_up_max_updates).run()
+        return
+
+    with startup.phase("dispatcher"):
+        setup_dispatcher(updater.dispatcher)
+
+    with startup.phase("backgrounds"):
+        # imports the legacy backgrounds, if any
+        get_background_store()
+
+    if catch_up:
+        # the users who joined while the bot was offline still need to be restricted and challenged
+        with startup.phase("drain"):
+            backlog = drain_backlog(updater.bot, allowed_updates, max_updates=catch_up_max_updates)
+        with startup.phase("catch-up"):
+            catch_up_joins(updater.bot, updater.dispatcher, backlog)
+
+        for update in backlog.updates:
+            # processed as soon as the dispatcher starts
+            updater.update_queue.put(update)
+
+    with startup.phase("polling"):
+        updater.start_polling(drop_pending_updates=not catch_up, allowed_updates=allowed_updates)
+
+    logger.info("running, allowed updates: %s", allowed_updates)
+    logger.info("startup took %s", startup.summary())
     updater.idle()
 
 
@@ -0,0 +1,115 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict
+
+
+class Timing:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    @property
+    def average(self):
+        return self.total / self.count if self.count else 0.0
+
+    def as_dict(self):
+        return {"count": self.count, "avg_ms": round(self.average * 1000, 3), "max_ms": round(self.max * 1000, 3)}
+
+
+class Metrics:
+    """Thread-safe in-memory counters, gauges and timings"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Dict[str, int] = {}
+        self.gauges: Dict[str, float] = {}
+        self.timings: Dict[str, Timing] = {}
+
+    def incr(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name: str, value: float):
+        self.gauges[name] = value
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                timing = self.timings[name] = Timing()
+            timing.observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self, prefix: str = ""):
+        with self._lock:
+            return {
+                "counters": {k: v for k, v in sorted(self.counters.items()) if k.startswith(prefix)},
+                "gauges": {k: v for k, v in sorted(self.gauges.items()) if k.startswith(prefix)},
+                "timings": {k: v.as_dict() for k, v in sorted(self.timings.items()) if k.startswith(prefix)},
+            }
+
+    def format(self, prefix: str = ""):
+        snapshot = self.snapshot(prefix)
+
+        lines = []
+        for name, value in snapshot["counters"].items():
+            lines.append(f"{name}: {value}")
+        for name, value in snapshot["gauges"].items():
+            lines.append(f"{name}: {value}")
+        for name, timing in snapshot["timings"].items():
+            lines.append(f"{name}: {timing['count']} x {timing['avg_ms']} ms (max {timing['max_ms']} ms)")
+
+        return "\n".join(lines)
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.timings.clear()
+
+
+class PhaseTimer:
+    """Wall time of consecutive phases (eg. the startup steps)"""
+
+    def __init__(self, name: str, registry: Metrics = None):
+        self.name = name
+        self.registry = registry
+        self.phases: Dict[str, float] = {}
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def phase(self, phase_name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.phases[phase_name] = elapsed
+            if self.registry:
+                self.registry.observe(f"{self.name}.{phase_name}", elapsed)
+
+    @property
+    def total(self):
+        return time.perf_counter() - self.start
+
+    def summary(self):
+        phases = ", ".join(f"{name}: {seconds * 1000:.1f} ms" for name, seconds in self.phases.items())
+        return f"{self.total * 1000:.1f} ms ({phases})"
+
+
+metrics = Metrics()
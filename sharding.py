@@ -0,0 +1,185 @@
+import json
+import logging
+import multiprocessing
+import time
+import zlib
+from logging.handlers import QueueListener
+from typing import List, Optional
+
+from telegram import Update, Bot, TelegramError
+
+from catchup import drain_backlog
+
+logger = logging.getLogger(__name__)
+
+POLL_TIMEOUT = 10  # getUpdates long polling timeout (seconds)
+POLL_MAX_BACKOFF = 30  # max seconds to wait before polling again after an error (like Updater)
+WORKER_STOP = None  # sentinel put in a worker's queue to stop it
+
+
+def shard_for_chat(chat_id: int, shards: int) -> int:
+    # crc32 is cheap and spreads consecutive chat ids evenly
+    return zlib.crc32(str(chat_id).encode()) % shards
+
+
+def update_routing_key(update: Update) -> int:
+    # all the updates of a chat must be processed by the same worker, because it owns the chat's captchas
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+
+    return 0
+
+
+class ShardRouter:
+    def __init__(self, shards: int):
+        if shards < 1:
+            raise ValueError(f"the number of shards must be at least 1 ({shards})")
+
+        self.shards = shards
+        self.routed = [0] * shards
+
+    def route(self, update: Update) -> int:
+        shard = shard_for_chat(update_routing_key(update), self.shards)
+        self.routed[shard] += 1
+
+        return shard
+
+
+class ForwardHandler(logging.Handler):
+    """Logs again, in the supervisor, the records sent by the workers: only the supervisor writes the log files"""
+
+    def emit(self, record: logging.LogRecord):
+        logging.getLogger(record.name).handle(record)
+
+
+def worker_main(shard_id: int, updates_queue: multiprocessing.Queue, log_queue: multiprocessing.Queue):
+    # imported here so the worker process builds its own bot, dispatcher and job queue
+    from main import build_updater, setup_dispatcher, load_logging_config
+
+    # the same rotating file can't be written by more than one process
+    load_logging_config("logging.json", log_queue=log_queue)
+    updater = build_updater()
+    worker_logger = logging.getLogger(f"{__name__}.worker{shard_id}")
+
+    dispatcher = updater.dispatcher
+    setup_dispatcher(dispatcher)
+    updater.job_queue.start()
+
+    worker_logger.info("worker %d started", shard_id)
+    while True:
+        try:
+            data = updates_queue.get()
+        except (KeyboardInterrupt, EOFError):
+            break
+
+        if data is WORKER_STOP:
+            break
+
+        update = Update.de_json(json.loads(data), updater.bot)
+        dispatcher.process_update(update)
+
+    updater.job_queue.stop()
+    worker_logger.info("worker %d stopped", shard_id)
+
+
+class Supervisor:
+    def __init__(self, bot: Bot, shards: int, allowed_updates: Optional[List[str]] = None, catch_up: bool = True,
+                 catch_up_max_updates: int = 10000):
+        self.bot = bot
+        self.catch_up = catch_up
+        self.catch_up_max_updates = catch_up_max_updates
+        self.router = ShardRouter(shards)
+        self.allowed_updates = allowed_updates
+        self.context = multiprocessing.get_context("spawn")
+        self.queues = [self.context.Queue() for _ in range(shards)]
+        self.log_queue = self.context.Queue()
+        self.log_listener = QueueListener(self.log_queue, ForwardHandler())
+        self.workers: List[Optional[multiprocessing.Process]] = [None] * shards
+
+    def start_worker(self, shard_id: int):
+        process = self.context.Process(
+            target=worker_main,
+            args=(shard_id, self.queues[shard_id], self.log_queue),
+            name=f"shard-{shard_id}",
+            daemon=True
+        )
+        process.start()
+        self.workers[shard_id] = process
+
+        logger.info("started worker %d (pid %d)", shard_id, process.pid)
+
+    def check_workers(self):
+        for shard_id, process in enumerate(self.workers):
+            if process is None or not process.is_alive():
+                if process is not None:
+                    logger.error("worker %d died (exit code %s), restarting it", shard_id, process.exitcode)
+                self.start_worker(shard_id)
+
+    def dispatch(self, update: Update):
+        shard = self.router.route(update)
+        self.queues[shard].put(update.to_json())
+
+    def drop_pending_updates(self) -> int:
+        # same as Updater.start_polling(drop_pending_updates=True)
+        updates = self.bot.get_updates(offset=-1, timeout=0, allowed_updates=self.allowed_updates)
+        if not updates:
+            return 0
+
+        return updates[-1].update_id + 1
+
+    def replay_backlog(self) -> Optional[int]:
+        # route the updates received while offline, with duplicated and abandoned joins already coalesced
+        backlog = drain_backlog(self.bot, self.allowed_updates, max_updates=self.catch_up_max_updates)
+        for update in backlog.replay():
+            self.dispatch(update)
+
+        return backlog.offset
+
+    def run(self):
+        self.log_listener.start()
+        self.check_workers()
+
+        offset = self.replay_backlog() if self.catch_up else self.drop_pending_updates()
+        logger.info("supervisor polling with %d shards", self.router.shards)
+        backoff = 0
+        try:
+            while True:
+                try:
+                    updates = self.bot.get_updates(
+                        offset=offset,
+                        timeout=POLL_TIMEOUT,
+                        allowed_updates=self.allowed_updates
+                    )
+                    backoff = 0
+                except TelegramError as e:
+                    # eg. network down: don't hammer the api (and the logs)
+                    backoff = min(POLL_MAX_BACKOFF, backoff * 1.5 if backoff else 1)
+                    logger.error("error while polling for updates: %s (retrying in %.1f seconds)", str(e), backoff)
+                    time.sleep(backoff)
+                    continue
+
+                self.check_workers()
+                for update in updates:
+                    self.dispatch(update)
+                    offset = update.update_id + 1
+        except KeyboardInterrupt:
+            logger.info("stopping workers...")
+        finally:
+            self.stop()
+
+    def stop(self):
+        for updates_queue in self.queues:
+            updates_queue.put(WORKER_STOP)
+
+        for process in self.workers:
+            if process is None:
+                continue
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+
+        self.log_listener.stop()
+        logger.info("updates routed per shard: %s", self.router.routed)
+
@@ -2,15 +2,24 @@ import datetime
 import logging
 import os
 import pickle
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from functools import partial
 from html import escape
+from typing import Callable, List
 
 # noinspection PyPackageRequirements
 from telegram import Message, User, Bot
 # noinspection PyPackageRequirements
 from telegram.ext import PicklePersistence
 
+from api import current_retry_deadline, retry_deadline
+
 logger = logging.getLogger(__name__)
 
+# independent Bot API calls are network-bound, so they can run in parallel to each other and to the rendering
+API_EXECUTOR_WORKERS = 8
+api_executor = ThreadPoolExecutor(max_workers=API_EXECUTOR_WORKERS, thread_name_prefix="api")
+
 
 def now_utc():
     return datetime.datetime.utcnow()
@@ -20,6 +29,16 @@ def html_escape(string: str):
     return escape(string)
 
 
+def slim_user(user: User) -> User:
+    # a copy with only the fields needed to mention the user
+    return User(user.id, user.first_name, is_bot=user.is_bot, last_name=user.last_name, username=user.username)
+
+
+def text_length(text: str) -> int:
+    # length as counted by Telegram (utf-16 code units)
+    return len(text.encode("utf-16-le")) // 2
+
+
 def mention_escaped(user: User, label="", full_name=False):
     if not label:
         label = user.first_name if not full_name else user.full_name
@@ -67,3 +86,35 @@ def persistence_object(file_path='persistence/data.pickle'):
         store_bot_data=False
     )
 
+
+def _run_with_deadline(func: Callable, deadline: float):
+    with retry_deadline(deadline):
+        return func()
+
+
+def run_concurrently(*funcs: Callable) -> List[Future]:
+    # start every callable in the api executor, use functools.partial to pass arguments.
+    # The callables don't wait for retries past the caller's retry deadline
+    deadline = current_retry_deadline()
+    if deadline:
+        funcs = [partial(_run_with_deadline, func, deadline) for func in funcs]
+
+    return [api_executor.submit(func) for func in funcs]
+
+
+def run_detached(*funcs: Callable) -> List[Future]:
+    # like run_concurrently(), for calls that must go through even if the caller can't wait for them (eg. unmuting
+    # a user): they get all the retries of the request layer, not just the ones within the caller's retry deadline
+    return [api_executor.submit(func) for func in funcs]
+
+
+def wait_all(futures: List[Future]):
+    # wait for every future to complete, then raise the first exception (if any)
+    wait(futures)
+
+    results = []
+    for future in futures:
+        results.append(future.result())
+
+    return results
+